@@ -0,0 +1,171 @@
+"""Seeded generator of synthetic documents for the benchmarks.
+
+Every shape stresses a different path of the parser:
+
+    prose         plain paragraphs, comments and escaped characters
+    macros        dense inline stdlib functions
+    nesting       deeply nested function arguments
+    environments  many \\begin / \\end environments
+    math          inline math with symbols and comparisons
+    library       large \\newcommand library built on stdlib
+
+The same shape, size and seed always give the same document.
+"""
+
+import os
+import random
+
+
+words = ('lorem ipsum dolor sit amet consectetur adipiscing elit sed do '
+         'eiusmod tempor incididunt ut labore et dolore magna aliqua ut enim '
+         'ad minim veniam quis nostrud exercitation ullamco laboris nisi ut '
+         'aliquip ex ea commodo consequat').split()
+
+stdlib_inline = ['em', 'strong', 'code', 'del', 'underline', 'monospace',
+                 'serif', 'sansserif']
+
+# functions defined in documents, available to every target
+preamble = '\n'.join([
+    '\\newcommand{grp: raw(text); ctx->ctx}{',
+    '    (#text)',
+    '}',
+    '\\newenvironment{note: raw(kind, *text); ctx->ctx; leaveblk}{',
+    '    [#kind] #text',
+    '}',
+    '',
+])
+
+
+def make_words(rng, count):
+    return ' '.join(rng.choice(words) for _ in range(count))
+
+
+def make_prose(rng):
+    """Paragraph of plain text with the occasional comment or escape."""
+    lines = []
+    for _ in range(rng.randint(2, 6)):
+        line = make_words(rng, rng.randint(6, 14))
+        roll = rng.random()
+        if roll < 0.15:
+            line += ' % ' + make_words(rng, 3)
+        elif roll < 0.3:
+            line += ' \\% \\{' + rng.choice(words) + '\\}'
+        lines.append(line)
+    return '\n'.join(lines)
+
+
+def make_macros(rng):
+    """Paragraph with a function call every few words."""
+    parts = []
+    for _ in range(rng.randint(10, 20)):
+        parts.append(make_words(rng, rng.randint(1, 3)))
+        parts.append('\\%s{%s}' % (rng.choice(stdlib_inline),
+                                   make_words(rng, rng.randint(1, 2))))
+    return ' '.join(parts)
+
+
+def make_nesting(rng):
+    """Paragraph made of one deeply nested group."""
+    depth = rng.randint(4, 12)
+    text = make_words(rng, 3)
+    for _ in range(depth):
+        text = '%s \\grp{%s} %s' % (rng.choice(words), text,
+                                    rng.choice(words))
+    return text
+
+
+def make_environments(rng):
+    """Environment holding a few lines of text."""
+    lines = ['\\begin{note}{%s}' % rng.choice(words)]
+    for _ in range(rng.randint(1, 4)):
+        lines.append(make_words(rng, rng.randint(4, 10)))
+    lines.append('\\end{note}')
+    return '\n'.join(lines)
+
+
+def make_math(rng):
+    """Paragraph with several inline equations."""
+    parts = []
+    for _ in range(rng.randint(3, 8)):
+        parts.append(make_words(rng, rng.randint(2, 6)))
+        terms = []
+        for _ in range(rng.randint(2, 6)):
+            terms.append(rng.choice(['x', 'y', 'z', '\\alpha', '\\beta',
+                                     'e^{i\\pi}', '\\frac{a}{b}']))
+        parts.append('$' + rng.choice([' + ', ' < ', ' > ', ' = ']).join(
+                     terms) + '$')
+    return ' '.join(parts)
+
+
+def make_library(rng, count):
+    """Library of count functions, each with both target definitions and an
+    alias chaining into stdlib.
+    @returns source(str), names(list(str))"""
+    defs = []
+    names = []
+    for i in range(count):
+        name = 'lib' + ''.join(rng.choice('abcdefghijklmnopqrstuvwxyz')
+                               for _ in range(6)) + str(i)
+        inner = rng.choice(stdlib_inline)
+        defs.append('\\newcommand{%sdoc: raw(text); ctx->doc}{\n'
+                    '    \\textsc{#text}\n}' % name)
+        defs.append('\\newcommand{%sdoc: raw(text); ctx->web}{\n'
+                    '    <span class="%s">#text</span>\n}' % (name, name))
+        defs.append('\\newcommand{%s: raw(text); ctx->ctx}{\n'
+                    '    \\%s{\\%sdoc{#text}}\n}' % (name, inner, name))
+        names.append(name)
+    source = '\n'.join(['---', 'name: benchlib', '---', ''] + defs) + '\n'
+    return source, names
+
+
+shapes = {
+    'prose': make_prose,
+    'macros': make_macros,
+    'nesting': make_nesting,
+    'environments': make_environments,
+    'math': make_math,
+    'library': None,
+}
+
+# shapes calling functions that only exist for the doc and web targets
+target_specific_shapes = {'macros', 'library'}
+
+
+def make_document(shape, size, seed=0, library_size=500):
+    """Create a document of roughly size characters.
+    @param shape(str) one of shapes
+    @param size(int) number of characters
+    @param seed(int) random seed
+    @param library_size(int) number of functions in generated library
+    @returns document(str), libraries(dict(str, str)) name and source of
+        libraries to be preloaded along with stdlib"""
+    rng = random.Random('%s/%d' % (shape, seed))
+    libraries = {}
+    if shape == 'library':
+        source, names = make_library(rng, library_size)
+        libraries['benchlib'] = source
+
+        def make_block(rng):
+            return ' '.join('%s \\%s{%s}' % (make_words(rng, 2),
+                                              rng.choice(names),
+                                              rng.choice(words))
+                            for _ in range(rng.randint(3, 8)))
+    else:
+        make_block = shapes[shape]
+    blocks = ['---\ntitle: %s benchmark\n---' % shape, preamble]
+    length = sum(len(i) + 2 for i in blocks)
+    while length < size:
+        block = make_block(rng)
+        blocks.append(block)
+        length += len(block) + 2
+    return '\n\n'.join(blocks) + '\n', libraries
+
+
+def write_libraries(libraries, folder):
+    """Write generated libraries into folder."""
+    for name, source in libraries.items():
+        fhandle = open(os.path.join(folder, name + '.tex'), 'w',
+                       encoding='utf-8')
+        fhandle.write(source)
+        fhandle.close()
+    return
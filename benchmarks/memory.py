@@ -0,0 +1,96 @@
+"""Measures memory held by function definitions and parser states.
+
+Loads a generated library of many \\newcommand definitions and reports the
+bytes retained per defined function, then keeps many parser states alive
+(as nested parsing does) and reports the bytes per state. Memory is
+counted with tracemalloc, so only Python allocations are included.
+
+    python benchmarks/memory.py --functions 5000
+"""
+
+import argparse
+import gc
+import json
+import os
+import sys
+import tempfile
+import tracemalloc
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, root)
+
+from comtext import kernel  # noqa: E402
+from comtext import loader  # noqa: E402
+from comtext import modules  # noqa: E402
+
+import corpus  # noqa: E402
+
+
+def get_traced():
+    gc.collect()
+    return tracemalloc.get_traced_memory()[0]
+
+
+def measure_functions(count, target, folder):
+    """Load a library of count functions.
+    @returns bytes per function(float), number of functions(int)"""
+    source, _ = corpus.make_library(corpus.random.Random(0), count)
+    corpus.write_libraries({'memlib': source}, folder)
+    functions = loader.make_default_functions()
+    pobj = kernel.Parser(filepath='.', filename='bench.ctx', document='',
+                         target=target, include_path=[folder])
+    state = pobj.create_parser_state(target='ctx', functions=functions,
+                                     document='')
+    before_cnt = len(list(state.macros))
+    before = get_traced()
+    modules.PfLoadLibrary.load_library(pobj, state, 'memlib')
+    # drop everything but the functions
+    macros = state.macros
+    del pobj, state
+    used = get_traced() - before
+    added = len(list(macros)) - before_cnt
+    return used / added, added
+
+
+def measure_states(count, target):
+    """Keep count parser states alive.
+    @returns bytes per state(float)"""
+    functions = loader.make_default_functions()
+    pobj = kernel.Parser(filepath='.', filename='bench.ctx', document='',
+                         target=target, include_path=[])
+    document = 'lorem ipsum'
+    before = get_traced()
+    states = []
+    for _ in range(count):
+        states.append(pobj.create_parser_state(target, functions,
+                                               document=document))
+    used = get_traced() - before
+    del states
+    return used / count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--functions', type=int, default=5000,
+                        help='names in generated library')
+    parser.add_argument('--states', type=int, default=10000)
+    parser.add_argument('--target', default='web', choices=['doc', 'web'])
+    args = parser.parse_args()
+    tracemalloc.start()
+    with tempfile.TemporaryDirectory() as folder:
+        per_function, added = measure_functions(args.functions, args.target,
+                                                folder)
+    per_state = measure_states(args.states, args.target)
+    report = {
+        'target': args.target,
+        'functions': added,
+        'bytes_per_function': per_function,
+        'states': args.states,
+        'bytes_per_state': per_state,
+    }
+    print(json.dumps(report, indent=2))
+    return
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+"""Measures how conversion time scales with the size of the output.
+
+Generates plain documents of growing size, converts them through the
+parser and reports throughput for each size. With linear-time output
+assembly the throughput stays flat as the output grows.
+
+    python benchmarks/output_scaling.py --max-mb 100
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from comtext import kernel  # noqa: E402
+from comtext import loader  # noqa: E402
+
+
+paragraph = ('Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed '
+             'do eiusmod tempor incididunt ut labore et dolore magna aliqua.'
+             '\n\n')
+
+
+def make_document(size):
+    """Create a document of roughly size characters."""
+    return paragraph * max(1, size // len(paragraph))
+
+
+def convert(document, target):
+    """Convert document and return (output length, seconds)."""
+    functions = loader.make_default_functions()
+    pobj = kernel.Parser(filepath='.', filename='bench.ctx',
+                         document=document, target=target, include_path=[])
+    begin = time.perf_counter()
+    pobj.parse(functions=functions)
+    elapsed = time.perf_counter() - begin
+    return len(pobj.document), elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--min-mb', type=float, default=0.125)
+    parser.add_argument('--max-mb', type=float, default=100.0)
+    parser.add_argument('--target', default='web',
+                        choices=['ctx', 'doc', 'web'])
+    args = parser.parse_args()
+    size = args.min_mb
+    print('%12s %12s %10s %14s' % ('input MB', 'output MB', 'seconds',
+                                   'chars/sec'))
+    while size <= args.max_mb:
+        document = make_document(int(size * 1024 * 1024))
+        out_len, elapsed = convert(document, args.target)
+        print('%12.3f %12.3f %10.3f %14.0f' % (
+              len(document) / 1048576, out_len / 1048576, elapsed,
+              len(document) / elapsed))
+        sys.stdout.flush()
+        size *= 2
+    return
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+"""Measures conversion speed of each parser stage over synthetic documents.
+
+Documents of every shape in corpus.py are converted to each target, timing
+the stages of Parser.parse separately: extracting the front matter,
+loading preloaded libraries (stdlib, and the generated library for the
+library shape), checking scope markers, the ctx pass and the target pass.
+The fastest of several rounds is reported per stage as JSON, so that
+results of two revisions can be compared by a script.
+
+    python benchmarks/suite.py --size 200000 --output before.json
+
+The ctx target drops functions defined for doc and web, so shapes calling
+stdlib functions are only converted to doc and web.
+"""
+
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, root)
+
+from comtext import keywords  # noqa: E402
+from comtext import kernel  # noqa: E402
+from comtext import loader  # noqa: E402
+from comtext import modules  # noqa: E402
+
+import corpus  # noqa: E402
+
+
+stages = ['extract_headers', 'load_libraries', 'check_scopes', 'ctx_pass',
+          'target_pass']
+
+
+def convert(document, target, preload_libs, include_path):
+    """Convert document the way Parser.parse does, timing every stage.
+    @returns output(str), timings(dict(str, float))"""
+    functions = loader.make_default_functions()
+    pobj = kernel.Parser(filepath='.', filename='bench.ctx',
+                         document=document, target=target,
+                         include_path=include_path)
+    timings = {}
+    begin = time.perf_counter()
+    pobj.extract_headers()
+    timings['extract_headers'] = time.perf_counter() - begin
+    state = pobj.create_parser_state(target='ctx', functions=functions,
+                                     document=pobj.document)
+    begin = time.perf_counter()
+    for lib in preload_libs:
+        modules.PfLoadLibrary.load_library(pobj, state, lib)
+    timings['load_libraries'] = time.perf_counter() - begin
+    begin = time.perf_counter()
+    pobj.check_scopes(state)
+    timings['check_scopes'] = time.perf_counter() - begin
+    begin = time.perf_counter()
+    output = pobj.parse_document(state)
+    timings['ctx_pass'] = time.perf_counter() - begin
+    timings['target_pass'] = 0.0
+    if target != 'ctx':
+        begin = time.perf_counter()
+        state = pobj.create_parser_state(target=target,
+                                         functions=state.macros,
+                                         document=output)
+        output = pobj.parse_document(state)
+        timings['target_pass'] = time.perf_counter() - begin
+    return output, timings
+
+
+def run_case(shape, target, args, folder):
+    """Convert one shape to one target for several rounds.
+    @returns result(dict)"""
+    document, libraries = corpus.make_document(
+        shape, args.size, seed=args.seed, library_size=args.library_size)
+    corpus.write_libraries(libraries, folder)
+    preload_libs = ['stdlib'] + sorted(libraries)
+    include_path = [os.path.join(root, 'libs'), folder]
+    best = None
+    for _ in range(args.rounds):
+        output, timings = convert(document, target, preload_libs,
+                                  include_path)
+        if best is None:
+            best = timings
+        else:
+            best = dict((i, min(best[i], timings[i])) for i in stages)
+    total = sum(best.values())
+    return {
+        'shape': shape,
+        'target': target,
+        'input_chars': len(document),
+        'output_chars': len(output),
+        'stages': best,
+        'total': total,
+        'chars_per_sec': len(document) / total,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--size', type=int, default=200000,
+                        help='characters per document')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--rounds', type=int, default=3,
+                        help='conversions per case, the fastest is kept')
+    parser.add_argument('--library-size', type=int, default=500,
+                        help='functions in generated library')
+    parser.add_argument('--shapes', nargs='+', default=list(corpus.shapes),
+                        choices=list(corpus.shapes))
+    parser.add_argument('--targets', nargs='+', default=['ctx', 'doc', 'web'],
+                        choices=['ctx', 'doc', 'web'])
+    parser.add_argument('--output', default=None,
+                        help='write JSON here instead of standard output')
+    args = parser.parse_args()
+    results = []
+    with tempfile.TemporaryDirectory() as folder:
+        for shape in args.shapes:
+            for target in args.targets:
+                if target == 'ctx' and \
+                        shape in corpus.target_specific_shapes:
+                    continue
+                result = run_case(shape, target, args, folder)
+                results.append(result)
+                print('%-12s %-3s %10.0f chars/sec' % (
+                      shape, target, result['chars_per_sec']),
+                      file=sys.stderr)
+    report = {
+        'version': keywords.ctx_version,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'size': args.size,
+        'seed': args.seed,
+        'rounds': args.rounds,
+        'results': results,
+    }
+    text = json.dumps(report, indent=2)
+    if args.output is None:
+        print(text)
+    else:
+        fhandle = open(args.output, 'w')
+        fhandle.write(text + '\n')
+        fhandle.close()
+    return
+
+
+if __name__ == '__main__':
+    main()
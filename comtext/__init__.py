@@ -1,7 +1,73 @@
-
+from . import aio
+from . import keywords
 from . import loader
 
+__version__ = keywords.ctx_version
+
 
-def parse(path, target, preload_libs=[], include_path=None):
+def parse(path, target=None, preload_libs=[], include_path=None,
+          library_cache=None, profile=False, targets=None, executor=None,
+          output_cache=None, limits=None):
+    if targets is not None:
+        if target is not None or profile or output_cache is not None or \
+                limits is not None:
+            raise ValueError(targets)
+        return loader.parse_file_targets(path, targets,
+                                         preload_libs=preload_libs,
+                                         include_path=include_path,
+                                         library_cache=library_cache,
+                                         executor=executor)
     return loader.parse_file(path, target, preload_libs=preload_libs,
-                             include_path=include_path)
+                             include_path=include_path,
+                             library_cache=library_cache, profile=profile,
+                             output_cache=output_cache, limits=limits)
+
+
+async def parse_async(path, target, preload_libs=[], include_path=None,
+                      library_cache=None, output_cache=None, limits=None,
+                      converter=None):
+    return await aio.get_converter(converter).parse(
+        path, target, preload_libs=preload_libs, include_path=include_path,
+        library_cache=library_cache, output_cache=output_cache,
+        limits=limits)
+
+
+async def parse_text_async(text, target, preload_libs=[], include_path=None,
+                           library_cache=None, path='', limits=None,
+                           converter=None):
+    return await aio.get_converter(converter).parse_text(
+        text, target, preload_libs=preload_libs, include_path=include_path,
+        library_cache=library_cache, path=path, limits=limits)
+
+
+def parse_iter(path, target, preload_libs=[], include_path=None,
+               library_cache=None):
+    return loader.parse_file_iter(path, target, preload_libs=preload_libs,
+                                  include_path=include_path,
+                                  library_cache=library_cache)
+
+
+def parse_to(path, fileobj, target, preload_libs=[], include_path=None,
+             library_cache=None):
+    return loader.parse_file_to(path, fileobj, target,
+                                preload_libs=preload_libs,
+                                include_path=include_path,
+                                library_cache=library_cache)
+
+
+def parse_many(jobs, preload_libs=[], include_path=None, library_cache=None,
+               processes=None, max_pending=None, output_cache=None,
+               limits=None):
+    return loader.parse_many(jobs, preload_libs=preload_libs,
+                             include_path=include_path,
+                             library_cache=library_cache,
+                             processes=processes, max_pending=max_pending,
+                             output_cache=output_cache, limits=limits)
+
+
+def read_headers(path):
+    return loader.read_headers(path)
+
+
+def read_headers_many(paths, processes=None):
+    return loader.read_headers_many(paths, processes=processes)
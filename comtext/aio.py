@@ -0,0 +1,97 @@
+import asyncio
+import concurrent.futures
+import os
+
+from . import loader
+
+
+class AsyncConverter:
+    """Converts documents without blocking the event loop. Reading documents
+    and libraries and parsing them are run in an executor, which is a thread
+    pool unless given. At most max_running conversions are handed to the
+    executor at the same time, further callers wait for one of them to
+    finish."""
+
+    def __init__(self, executor=None, max_running=None):
+        if max_running is None:
+            max_running = os.cpu_count() or 1
+        self.executor = executor
+        self.own_executor = executor is None  # shut down along with this
+        self.max_running = max_running
+        self.semaphore = None  # created within the loop using it
+        self.loop = None
+        return
+
+    def get_executor(self):
+        if self.executor is None:
+            self.executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.max_running)
+        return self.executor
+
+    def get_semaphore(self, loop):
+        if self.loop is not loop:
+            self.semaphore = asyncio.Semaphore(self.max_running)
+            self.loop = loop
+        return self.semaphore
+
+    async def run(self, func, *args, **kwargs):
+        """Run func in the executor once fewer than max_running conversions
+        are running.
+        @returns result(...) value returned by func"""
+        loop = asyncio.get_running_loop()
+        semaphore = self.get_semaphore(loop)
+        await semaphore.acquire()
+        try:
+            future = self.get_executor().submit(func, *args, **kwargs)
+        except BaseException:
+            semaphore.release()
+            raise
+        # conversions keep running if the caller is cancelled, and are only
+        # counted off when they are done
+        future.add_done_callback(
+            lambda _: loop.call_soon_threadsafe(semaphore.release))
+        return await asyncio.wrap_future(future)
+
+    async def parse(self, path, target, preload_libs=[], include_path=None,
+                    library_cache=None, output_cache=None, limits=None):
+        """Convert document, see loader.parse_file.
+        @returns output(dict)"""
+        return await self.run(loader.parse_file, path, target,
+                              preload_libs=preload_libs,
+                              include_path=include_path,
+                              library_cache=library_cache,
+                              output_cache=output_cache, limits=limits)
+
+    async def parse_text(self, text, target, preload_libs=[],
+                         include_path=None, library_cache=None, path='',
+                         limits=None):
+        """Convert document given as text, see loader.parse_text.
+        @returns output(dict)"""
+        return await self.run(loader.parse_text, text, target,
+                              preload_libs=preload_libs,
+                              include_path=include_path,
+                              library_cache=library_cache, path=path,
+                              limits=limits)
+
+    def shutdown(self, wait=True):
+        """Shut down the executor, if created by this."""
+        if self.own_executor and self.executor is not None:
+            self.executor.shutdown(wait=wait)
+            self.executor = None
+        return
+    pass
+
+
+default_converter = None
+
+
+def get_converter(converter=None):
+    """Get given converter, or the one shared in process.
+    @param converter(AsyncConverter/None)
+    @returns converter(AsyncConverter)"""
+    global default_converter
+    if converter is not None:
+        return converter
+    if default_converter is None:
+        default_converter = AsyncConverter()
+    return default_converter
@@ -0,0 +1,489 @@
+import collections
+import hashlib
+import os
+import pickle
+import sys
+import tempfile
+import time
+
+from . import keywords
+
+
+class LibraryCache:
+    """Persistent storage of macros compiled from libraries. Entries are
+    indexed by the library's absolute path, content hash, conversion target
+    and comTeXT version, and are kept in memory once read or written. When
+    path is None, entries are only kept in memory."""
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}  # key -> serialized entry
+        self.hits = 0
+        self.misses = 0
+        return
+
+    @staticmethod
+    def get_digest(content):
+        """Get content hash of a library.
+        @param content(str) library source
+        @returns digest(str)"""
+        return hashlib.sha256(content.encode(keywords.ctx_file_encoding))\
+            .hexdigest()
+
+    @staticmethod
+    def read_library(path):
+        """Read library source and its content hash.
+        @param path(str) path to library
+        @returns content(str), digest(str)"""
+        fhandle = open(path, 'r', encoding=keywords.ctx_file_encoding)
+        content = fhandle.read()
+        fhandle.close()
+        return content, LibraryCache.get_digest(content)
+
+    def make_key(self, path, digest, target, include_path, loaded=()):
+        """Create cache key for library.
+        @param path(str) path to library
+        @param digest(str) content hash of library
+        @param target(str) conversion target
+        @param include_path(list(str)) where nested libraries are searched
+        @param loaded(set(str)) libraries loaded beforehand, which the
+            library would not load again
+        @returns key(str)"""
+        key = repr((os.path.abspath(path), digest, target,
+                    list(os.path.abspath(i) for i in include_path),
+                    sorted(loaded),
+                    keywords.ctx_version, keywords.ctx_cache_version,
+                    sys.implementation.cache_tag))
+        return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+    def get_entry_path(self, key):
+        return os.path.join(self.path, key + '.pickle')
+
+    def load(self, key, known={}, usable=None):
+        """Get cached entry, provided that the libraries it was built from
+        had not been modified.
+        @param key(str) created by make_key
+        @param known(dict) {path: digest, ...} of libraries just read, not
+            read again
+        @param usable(function/None) tells if the entry can be used, those
+            rejected count as misses
+        @returns entry(dict/None) {'macros': [(name, function), ...],
+            'dependencies': {path: digest, ...}}"""
+        data = self.entries.get(key, None)
+        if data is None and self.path is not None:
+            try:
+                fhandle = open(self.get_entry_path(key), 'rb')
+                data = fhandle.read()
+                fhandle.close()
+            except OSError:
+                data = None
+        entry = None
+        if data is not None:
+            try:
+                entry = pickle.loads(data)
+            except Exception:
+                entry = None
+        if entry is not None:
+            for path, digest in entry['dependencies'].items():
+                if path in known:
+                    cur_digest = known[path]
+                else:
+                    try:
+                        _, cur_digest = LibraryCache.read_library(path)
+                    except OSError:
+                        cur_digest = None
+                if cur_digest != digest:
+                    entry = None
+                    break
+        if entry is not None and usable is not None and not usable(entry):
+            self.misses += 1
+            return None
+        if entry is None:
+            self.entries.pop(key, None)
+            self.misses += 1
+            return None
+        self.entries[key] = data
+        self.hits += 1
+        return entry
+
+    def store(self, key, entry):
+        """Save entry to cache, silently ignored if unable to write.
+        @param key(str) created by make_key
+        @param entry(dict) see load"""
+        data = pickle.dumps(entry, protocol=pickle.HIGHEST_PROTOCOL)
+        self.entries[key] = data
+        if self.path is None:
+            return
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        except OSError:
+            return
+        try:
+            with os.fdopen(fd, 'wb') as fhandle:
+                fhandle.write(data)
+            os.replace(tmp_path, self.get_entry_path(key))
+        except OSError:
+            os.remove(tmp_path)
+        return
+    pass
+
+
+class ResultCache:
+    """Least recently used results of pure functions, bounded in size."""
+
+    def __init__(self, size):
+        self.size = size
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        return
+
+    def get(self, key):
+        """Get stored result and mark it as recently used.
+        @returns entry(...) None if not found"""
+        entry = self.entries.get(key, None)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def put(self, key, entry):
+        """Store result, dropping the least recently used one if full."""
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+        return
+
+    def get_statistics(self):
+        """@returns statistics(dict) hits, misses and number of entries"""
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'entries': len(self.entries),
+        }
+    pass
+
+
+class OutputCache:
+    """Persistent storage of converted documents. Entries are indexed by the
+    content hash of the document, conversion target, preloaded libraries and
+    comTeXT version, and are only used if the libraries the document loaded
+    had not been modified since. The least recently used entries are dropped
+    once all of them take more than size bytes. When path is None, entries
+    are only kept in memory."""
+
+    def __init__(self, path, size=keywords.output_cache_size):
+        self.path = path
+        self.size = size
+        self.entries = {}  # key -> serialized entry
+        self.index = None  # key -> bytes of entry, least recently used first
+        self.used = 0  # bytes of all entries
+        self.index_mtime = None  # of path when index was read
+        self.hits = 0
+        self.misses = 0
+        return
+
+    def make_key(self, path, target, preload_libs, include_path):
+        """Create cache key for document.
+        @param path(str) path to document
+        @param target(str) conversion target
+        @param preload_libs(list(str)) libraries loaded before document
+        @param include_path(list(str)) where libraries are searched
+        @returns key(str)"""
+        fhandle = open(path, 'rb')
+        digest = hashlib.sha256(fhandle.read()).hexdigest()
+        fhandle.close()
+        key = repr((digest, target, list(preload_libs),
+                    list(os.path.abspath(i) for i in include_path),
+                    keywords.ctx_version, keywords.ctx_cache_version))
+        return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+    def get_entry_path(self, key):
+        return os.path.join(self.path, key + '.pickle')
+
+    def get_path_mtime(self):
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except OSError:
+            return None
+
+    def get_index(self):
+        """Get sizes of entries, reading those left in path by earlier runs
+        on first use."""
+        if self.index is not None:
+            return self.index
+        self.index = collections.OrderedDict()
+        self.used = 0
+        if self.path is not None:
+            self.index_mtime = self.get_path_mtime()
+        found = []
+        try:
+            names = os.listdir(self.path) if self.path is not None else []
+        except OSError:
+            names = []
+        for name in names:
+            if not name.endswith('.pickle'):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.path, name))
+            except OSError:
+                continue
+            found.append((stat.st_mtime_ns, name[:-len('.pickle')],
+                          stat.st_size))
+        for _, key, size in sorted(found):
+            self.index[key] = size
+            self.used += size
+        return self.index
+
+    def refresh_index(self):
+        """Get sizes of entries, read again if entries were added or removed
+        by other processes sharing path, so that all of them together stay
+        within size."""
+        if self.path is not None and self.index is not None and \
+                self.get_path_mtime() != self.index_mtime:
+            self.index = None
+            index = self.get_index()
+            for key in list(self.entries):
+                if key not in index:
+                    del self.entries[key]
+        return self.get_index()
+
+    def remove(self, key):
+        """Drop entry from memory and path."""
+        index = self.get_index()
+        self.used -= index.pop(key, 0)
+        self.entries.pop(key, None)
+        if self.path is not None:
+            try:
+                os.remove(self.get_entry_path(key))
+            except OSError:
+                pass
+        return
+
+    def load(self, key):
+        """Get cached entry, provided that the libraries it was built from
+        had not been modified.
+        @param key(str) created by make_key
+        @returns entry(dict/None) {'document': str, 'headers': dict,
+            'dependencies': {path: digest, ...}}"""
+        index = self.get_index()
+        data = self.entries.get(key, None)
+        # may have been stored by other processes sharing path
+        if data is None and self.path is not None:
+            try:
+                fhandle = open(self.get_entry_path(key), 'rb')
+                data = fhandle.read()
+                fhandle.close()
+            except OSError:
+                data = None
+        entry = None
+        if data is not None:
+            try:
+                entry = pickle.loads(data)
+            except Exception:
+                entry = None
+        if entry is not None:
+            for path, digest in entry['dependencies'].items():
+                if get_library_digest(path) != digest:
+                    entry = None
+                    break
+        if entry is None:
+            if key in index:
+                self.remove(key)
+            self.misses += 1
+            return None
+        self.entries[key] = data
+        if key not in index:
+            index[key] = len(data)
+            self.used += len(data)
+        index.move_to_end(key)
+        if self.path is not None:
+            # recently used entries are kept by later runs as well
+            try:
+                os.utime(self.get_entry_path(key))
+            except OSError:
+                pass
+        self.hits += 1
+        return entry
+
+    def store(self, key, entry):
+        """Save entry to cache, dropping the least recently used ones if
+        full, silently ignored if unable to write.
+        @param key(str) created by make_key
+        @param entry(dict) see load"""
+        data = pickle.dumps(entry, protocol=pickle.HIGHEST_PROTOCOL)
+        if len(data) > self.size:
+            return
+        index = self.refresh_index()
+        if key in index:
+            self.remove(key)
+        while self.used + len(data) > self.size:
+            self.remove(next(iter(index)))
+        if self.path is not None:
+            try:
+                os.makedirs(self.path, exist_ok=True)
+                fd, tmp_path = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+            except OSError:
+                return
+            try:
+                with os.fdopen(fd, 'wb') as fhandle:
+                    fhandle.write(data)
+                os.replace(tmp_path, self.get_entry_path(key))
+            except OSError:
+                os.remove(tmp_path)
+                return
+            self.index_mtime = self.get_path_mtime()
+        self.entries[key] = data
+        index[key] = len(data)
+        self.used += len(data)
+        return
+
+    def get_statistics(self):
+        """@returns statistics(dict) hits, misses, number of entries and
+            bytes they take"""
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'entries': len(self.get_index()),
+            'bytes': self.used,
+        }
+    pass
+
+
+class LibraryResolver:
+    """Finds the files of libraries in include folders. The files in each
+    folder are listed once and looked up in memory from then on, and the
+    file each library name resolved to is remembered. Folders are checked
+    for changes, by their modification time, at most once every interval
+    seconds."""
+
+    def __init__(self, interval=keywords.library_index_interval):
+        self.interval = interval
+        # folder -> [modification time, names of files, time checked]
+        self.listings = {}
+        # (module name, include path) -> [path, time resolved]
+        self.resolved = {}
+        self.scans = 0  # folders listed
+        return
+
+    @staticmethod
+    def get_folder_mtime(folder):
+        try:
+            return os.stat(folder).st_mtime_ns
+        except OSError:
+            return None
+
+    def get_listing(self, folder, now):
+        """Get names of the files in folder.
+        @param now(float) time of the lookup
+        @returns names(frozenset(str)) empty if there is no such folder"""
+        listing = self.listings.get(folder, None)
+        if listing is not None and now - listing[2] < self.interval:
+            return listing[1]
+        mtime = self.get_folder_mtime(folder)
+        if listing is None or mtime is None or listing[0] != mtime:
+            names = set()
+            if mtime is not None:
+                self.scans += 1
+                try:
+                    for entry in os.scandir(folder):
+                        if entry.is_file():
+                            names.add(os.path.normcase(entry.name))
+                except OSError:
+                    pass
+            listing = [mtime, frozenset(names), now]
+            self.listings[folder] = listing
+        listing[2] = now
+        return listing[1]
+
+    def resolve(self, module_name, include_path):
+        """Find library file, in the first folder of include path holding it
+        with any of the known extensions.
+        @param module_name(str) name of library, may contain folders
+        @param include_path(list(str)) folders to search in order
+        @returns folder(str), filename(str) or None if not found"""
+        now = time.monotonic()
+        key = (module_name, tuple(include_path))
+        memo = self.resolved.get(key, None)
+        if memo is not None and now - memo[1] < self.interval:
+            return memo[0]
+        fpath = os.path.dirname(module_name)
+        fname = os.path.basename(module_name)
+        res = None
+        for folder in include_path:
+            npath = os.path.join(folder, fpath)
+            names = self.get_listing(npath, now)
+            for ext in keywords.ctx_file_extensions:
+                nname = fname + '.' + ext
+                if os.path.normcase(nname) in names:
+                    res = (npath, nname)
+                    break
+            if res is not None:
+                break
+        self.resolved[key] = [res, now]
+        return res
+
+    def invalidate(self):
+        """Check every folder for changes on its next use."""
+        for listing in self.listings.values():
+            listing[2] = float('-inf')
+        for memo in self.resolved.values():
+            memo[1] = float('-inf')
+        return
+    pass
+
+
+file_digests = {}  # path -> (modification time, size, content hash)
+
+
+def get_library_digest(path):
+    """Get content hash of library, see LibraryCache.get_digest, computed
+    again only once the file is modified.
+    @param path(str) path to library
+    @returns digest(str/None) None if unable to read"""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    memo = file_digests.get(path, None)
+    if memo is not None and memo[:2] == (stat.st_mtime_ns, stat.st_size):
+        return memo[2]
+    try:
+        _, digest = LibraryCache.read_library(path)
+    except OSError:
+        return None
+    file_digests[path] = (stat.st_mtime_ns, stat.st_size, digest)
+    return digest
+
+
+library_caches = {}  # path -> LibraryCache
+output_caches = {}  # path -> OutputCache
+library_resolver = LibraryResolver()  # shared in process
+
+
+def get_library_cache(path):
+    """Get library cache residing in given directory, shared in process.
+    @param path(str/LibraryCache/None) directory of cache
+    @returns cache(LibraryCache/None)"""
+    if path is None or isinstance(path, LibraryCache):
+        return path
+    path = os.path.abspath(path)
+    if path not in library_caches:
+        library_caches[path] = LibraryCache(path)
+    return library_caches[path]
+
+
+def get_output_cache(path):
+    """Get output cache residing in given directory, shared in process.
+    @param path(str/OutputCache/None) directory of cache
+    @returns cache(OutputCache/None)"""
+    if path is None or isinstance(path, OutputCache):
+        return path
+    path = os.path.abspath(path)
+    if path not in output_caches:
+        output_caches[path] = OutputCache(path)
+    return output_caches[path]
@@ -0,0 +1,274 @@
+import argparse
+import os
+import sys
+import time
+
+from . import cache
+from . import keywords
+from . import loader
+
+from .error import ParserError
+
+
+def collect_documents(inputs):
+    """Find documents among given files and directory trees.
+    @param inputs(list(str)) paths to files or directories
+    @returns docs(list((str, str))) pairs of document path and the folder its
+        output path is relative to"""
+    docs = []
+    for item in inputs:
+        if not os.path.isdir(item):
+            docs.append((item, os.path.dirname(item)))
+            continue
+        for path in loader.iter_documents(item):
+            docs.append((path, item))
+    return docs
+
+
+def get_output_path(path, root, target, output_dir):
+    """Get where the converted document is written to.
+    @param path(str) document path
+    @param root(str) folder that the document was found in
+    @param target(str) conversion target
+    @param output_dir(str/None) output folder, beside document if None"""
+    name = os.path.splitext(path)[0] + '.' + \
+        keywords.ctx_output_extensions[target]
+    if output_dir is None:
+        return name
+    return os.path.join(output_dir, os.path.relpath(name, root))
+
+
+def format_error(path, err):
+    """Format conversion error for display.
+    @param path(str) document path
+    @param err(Exception) error raised while converting"""
+    if not isinstance(err, ParserError):
+        return '%s: %s' % (path, err)
+    cause = err.cause()
+    return '%s:%d:%d: %s' % (os.path.join(cause['path'], cause['file']),
+                             cause['row'] + 1, cause['col'] + 1,
+                             cause['cause'])
+
+
+def get_mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+class Builder:
+    """Converts documents and remembers what each of them depends on, so that
+    only outdated documents are converted again."""
+
+    def __init__(self, args):
+        self.target = args.target
+        self.output_dir = args.output
+        self.preload_libs = args.preload
+        self.include_path = args.include_path or None
+        self.quiet = args.quiet
+        self.depfile = args.depfile
+        self.limits = None
+        if args.time_limit is not None:
+            self.limits = {'time': args.time_limit}
+        # libraries stay compiled between builds even without a cache folder
+        if args.library_cache is not None:
+            self.library_cache = cache.get_library_cache(args.library_cache)
+        else:
+            self.library_cache = cache.LibraryCache(None)
+        self.preloaded = None
+        self.preload_error = None  # last error printed on preloading
+        self.records = {}  # document -> {dependency: mtime}
+        return
+
+    def get_preloaded(self):
+        if self.preloaded is None:
+            self.preloaded = loader.preload_functions(
+                self.target, preload_libs=self.preload_libs,
+                include_path=self.include_path,
+                library_cache=self.library_cache)
+        return self.preloaded
+
+    def reload_preloaded(self):
+        """Preload libraries again, keeping the functions preloaded before if
+        any of them fails to load. Errors are only printed once.
+        @returns success(bool)"""
+        try:
+            preloaded = loader.preload_functions(
+                self.target, preload_libs=self.preload_libs,
+                include_path=self.include_path,
+                library_cache=self.library_cache)
+        except Exception as err:
+            msg = format_error(', '.join(self.preload_libs), err)
+            if msg != self.preload_error:
+                print(msg, file=sys.stderr)
+                self.preload_error = msg
+            return False
+        self.preload_error = None
+        self.preloaded = preloaded
+        return True
+
+    def write(self, path, root, document, dependencies):
+        """Write converted document, and the files it depends on if asked.
+        @param dependencies(iter(str)) libraries loaded by document"""
+        out_path = get_output_path(path, root, self.target, self.output_dir)
+        if os.path.abspath(out_path) == os.path.abspath(path):
+            raise ValueError('output would overwrite source, specify an '
+                             'output folder')
+        folder = os.path.dirname(out_path)
+        if folder != '':
+            os.makedirs(folder, exist_ok=True)
+        fhandle = open(out_path, 'w', encoding=keywords.ctx_file_encoding)
+        fhandle.write(document)
+        fhandle.close()
+        if self.depfile:
+            loader.write_depfile(
+                out_path + '.' + keywords.ctx_depfile_extension, out_path,
+                [path] + list(dependencies))
+        if not self.quiet:
+            print('%s -> %s' % (path, out_path))
+        return
+
+    def build(self, path, root):
+        """Convert document and record its dependencies.
+        @returns success(bool)"""
+        record = {path: get_mtime(path)}
+        self.records[path] = record
+        pobj = None
+        try:
+            pobj, functions, preload_libs = loader.open_file(
+                path, self.target, include_path=self.include_path,
+                library_cache=self.library_cache,
+                preloaded=self.get_preloaded(), limits=self.limits)
+            pobj.parse(functions=functions, preload_libs=preload_libs)
+            self.write(path, root, pobj.document, pobj.dependencies)
+        except Exception as err:
+            print(format_error(path, err), file=sys.stderr)
+            if pobj is None:
+                return False
+            # libraries loaded so far may be fixed, and missing ones added
+            # to any of the folders searched
+            folders = list(pobj.include_path)
+            for dep in pobj.dependencies:
+                record[dep] = get_mtime(dep)
+                folders.append(os.path.dirname(dep))
+            for folder in folders:
+                if folder not in record:
+                    record[folder] = get_mtime(folder)
+            return False
+        for dep in pobj.dependencies:
+            record[dep] = get_mtime(dep)
+        return True
+
+    def build_all(self, docs, jobs=1):
+        """Convert all documents, in parallel if jobs > 1.
+        @returns success(bool)"""
+        success = True
+        if jobs <= 1:
+            for path, root in docs:
+                success = self.build(path, root) and success
+            return success
+        roots = dict(docs)
+        results = loader.parse_many(
+            ((path, self.target) for path, _ in docs),
+            preload_libs=self.preload_libs, include_path=self.include_path,
+            library_cache=self.library_cache.path, processes=jobs,
+            limits=self.limits)
+        for path, _, result in results:
+            try:
+                if isinstance(result, Exception):
+                    raise result
+                self.write(path, roots[path], result['document'],
+                           result['dependencies'])
+            except Exception as err:
+                print(format_error(path, err), file=sys.stderr)
+                success = False
+        return success
+
+    def is_outdated(self, path, mtimes):
+        """If document or any of its dependencies changed since last build.
+        @param mtimes(dict) modification times gathered in this round"""
+        for dep, mtime in self.records[path].items():
+            if dep not in mtimes:
+                mtimes[dep] = get_mtime(dep)
+            if mtimes[dep] != mtime:
+                return True
+        return False
+
+    def watch(self, inputs, interval):
+        """Rebuild outdated documents until interrupted."""
+        preload_mtimes = None  # of libraries behind preloaded functions
+        while True:
+            mtimes = {}
+            # changed preloaded libraries invalidate every document, once
+            # they load again
+            changed = preload_mtimes is None
+            for dep, mtime in (preload_mtimes or {}).items():
+                mtimes[dep] = get_mtime(dep)
+                if mtimes[dep] != mtime:
+                    changed = True
+            if changed and self.reload_preloaded():
+                preload_mtimes = dict((dep, get_mtime(dep)) for dep in
+                                      self.preloaded.dependencies)
+                self.records = {}
+            if self.preloaded is not None:
+                docs = collect_documents(inputs)
+                for path in set(self.records) - set(i for i, _ in docs):
+                    del self.records[path]
+                for path, root in docs:
+                    if path not in self.records or \
+                            self.is_outdated(path, mtimes):
+                        self.build(path, root)
+            time.sleep(interval)
+            # libraries may have been added or removed since
+            cache.library_resolver.invalidate()
+        return
+    pass
+
+
+def make_argument_parser():
+    parser = argparse.ArgumentParser(
+        prog='comtext',
+        description='Convert comTeXT documents.')
+    parser.add_argument('inputs', nargs='+', metavar='PATH',
+                        help='documents or folders containing documents')
+    parser.add_argument('-t', '--target', default='web',
+                        choices=['ctx', 'doc', 'web'],
+                        help='conversion target (default: web)')
+    parser.add_argument('-o', '--output', default=None, metavar='DIR',
+                        help='output folder, beside documents by default')
+    parser.add_argument('-p', '--preload', action='append', default=[],
+                        metavar='LIB', help='preload library')
+    parser.add_argument('-I', '--include-path', action='append', default=[],
+                        metavar='DIR', help='library search folder')
+    parser.add_argument('--library-cache', default=None, metavar='DIR',
+                        help='keep compiled libraries in this folder')
+    parser.add_argument('-M', '--depfile', action='store_true',
+                        help='write the files each output depends on beside '
+                             'it, as a Makefile rule')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='number of worker processes')
+    parser.add_argument('--time-limit', type=float, default=None,
+                        metavar='SECONDS',
+                        help='give up on documents taking longer to convert')
+    parser.add_argument('-w', '--watch', action='store_true',
+                        help='rebuild documents as they or their libraries '
+                             'change')
+    parser.add_argument('--interval', type=float, default=0.5,
+                        help='seconds between checks in watch mode')
+    parser.add_argument('-q', '--quiet', action='store_true',
+                        help='only report errors')
+    return parser
+
+
+def main(argv=None):
+    args = make_argument_parser().parse_args(argv)
+    builder = Builder(args)
+    if args.watch:
+        try:
+            builder.watch(args.inputs, args.interval)
+        except KeyboardInterrupt:
+            pass
+        return 0
+    docs = collect_documents(args.inputs)
+    return 0 if builder.build_all(docs, jobs=args.jobs) else 1
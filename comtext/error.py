@@ -12,6 +12,7 @@ class ParserError(RuntimeError):
     }
 
     def __init__(self, cause):
+        RuntimeError.__init__(self, cause)  # keeps error picklable
         self.__parser_cause__ = cause
         return
 
@@ -0,0 +1,308 @@
+import bisect
+import os
+import re
+
+from . import cache
+from . import kernel
+from . import keywords
+from . import loader
+from . import misc
+from . import modules
+
+
+class Checkpoint:
+    """Snapshot of a top-level parser state at a paragraph break. Positions
+    are kept by PassResult, so that checkpoints need not be updated when
+    the text before them changes."""
+
+    def __init__(self, parser, state, chunk):
+        self.chunk = chunk  # number of output chunks written before
+        ab = state.autobreak
+        self.autobreak = (ab.opened, ab.space, ab.breaks, ab.enabled)
+        self.macros = state.macros.copy()
+        self.loaded_libraries = frozenset(parser.loaded_libraries)
+        self.py_exec_count = parser.py_exec_count
+        return
+
+    def restore(self, parser, state, pos):
+        """Set parser and state as they were at this checkpoint.
+        @param pos(int) position of checkpoint in current document"""
+        state.pos = pos
+        ab = state.autobreak
+        ab.opened, ab.space, ab.breaks, ab.enabled = self.autobreak
+        parser.loaded_libraries = set(self.loaded_libraries)
+        parser.py_exec_count = self.py_exec_count
+        return
+    pass
+
+
+class PassResult:
+    """Output of one pass (ctx or target) split at its checkpoints."""
+
+    def __init__(self, document):
+        self.document = document  # input of the pass
+        self.checkpoints = []
+        self.positions = []  # position of each checkpoint
+        self.segments = []  # output between consecutive checkpoints
+        self.macros = None  # macros after the pass
+        self.loaded_libraries = set()
+        self.py_exec_count = 0
+        return
+
+    def get_output(self):
+        return ''.join(self.segments)
+    pass
+
+
+class Converged(Exception):
+    """Raised when a reparse reaches a state identical to the previous run's,
+    after which the previous output is valid again."""
+
+    def __init__(self, index):
+        self.index = index  # index of matching checkpoint in previous run
+        return
+    pass
+
+
+def get_header_end(source):
+    """Get offset of the line break ending the front matter, or the first
+    non-empty line without front matter. Edits up to here may change the
+    front matter.
+    @param source(str) original document
+    @returns offset(int)"""
+    pos = 0
+    in_header = False
+    while True:
+        brk = source.find('\n', pos)
+        end = len(source) if brk == -1 else brk
+        line = source[pos:end]
+        if in_header:
+            if re.match(keywords.header_marker_end, line) is not None:
+                return end
+        elif re.match(keywords.header_marker_begin, line) is not None:
+            in_header = True
+        elif line.strip() != '':
+            return end
+        if brk == -1:
+            return len(source)
+        pos = brk + 1
+    return len(source)
+
+
+class IncrementalParser:
+    """Converts a document and keeps checkpoints at top-level paragraph
+    breaks, so that after an edit only the paragraphs from the last
+    checkpoint before the edit are parsed again, until the parser state
+    matches the previous run."""
+
+    def __init__(self, path, target, preload_libs=[], include_path=None,
+                 library_cache=None, preloaded=None):
+        if target not in {'ctx', 'doc', 'web'}:
+            raise ValueError(target)
+        if include_path is None:
+            include_path = keywords.ctx_include_path
+        self.filepath = os.path.dirname(path)
+        self.filename = os.path.basename(path)
+        self.target = target
+        self.preload_libs = preload_libs
+        self.include_path = include_path
+        self.library_cache = cache.get_library_cache(library_cache)
+        self.preloaded = preloaded
+        # results of last run
+        self.source = ''
+        self.header_end = 0
+        self.header_len = 0  # characters removed along with the front matter
+        self.headers = {}
+        self.document = ''
+        self.passes = []
+        self.dependencies = {}
+        self.context = None  # kept by functions between runs
+        return
+
+    def make_parser(self, document):
+        pobj = kernel.Parser(filepath=self.filepath,
+                             filename=self.filename,
+                             document=document,
+                             target=self.target,
+                             include_path=self.include_path,
+                             library_cache=self.library_cache,
+                             context=self.context)
+        if self.preloaded is not None:
+            pobj.loaded_libraries = set(self.preloaded.loaded_libraries)
+            pobj.dependencies = dict(self.preloaded.dependencies)
+        return pobj
+
+    def run_pass(self, pobj, state, result, old=None, edit_end=0, delta=0,
+                 restart=0):
+        """Parse from current state until the end or until the state
+        converges with the previous run.
+        @param result(PassResult) receives new checkpoints and segments
+        @param old(PassResult/None) previous run of this pass
+        @param edit_end(int) end of edited text in the new document
+        @param delta(int) change in length of the document
+        @param restart(int) index of checkpoint in old run to restart from
+        @returns index(int/None) index of matching checkpoint in the old run
+            if converged"""
+        builder = misc.OutputBuilder()
+        checkpoints = [Checkpoint(pobj, state, 0)]
+        positions = [state.pos]
+        if old is not None:
+            start = old.checkpoints[restart]
+
+        def checkpoint(state):
+            cp = Checkpoint(pobj, state, len(builder.chunks))
+            if old is not None and state.pos >= edit_end:
+                old_pos = state.pos - delta
+                j = bisect.bisect_left(old.positions, old_pos)
+                if j < len(old.positions) and old.positions[j] == old_pos:
+                    prev = old.checkpoints[j]
+                    if cp.autobreak == prev.autobreak and \
+                            cp.macros.data is prev.macros.data and \
+                            cp.loaded_libraries == prev.loaded_libraries and \
+                            cp.py_exec_count == start.py_exec_count and \
+                            prev.py_exec_count == start.py_exec_count:
+                        raise Converged(j)
+            checkpoints.append(cp)
+            positions.append(state.pos)
+            return
+        state.checkpoint = checkpoint
+        converged = None
+        try:
+            pobj.parse_document(state, output=builder)
+        except Converged as err:
+            converged = err.index
+        state.checkpoint = None
+        # split output at checkpoints
+        bounds = [cp.chunk for cp in checkpoints] + [len(builder.chunks)]
+        for i in range(0, len(checkpoints)):
+            result.segments.append(''.join(builder.chunks[
+                bounds[i]:bounds[i + 1]]))
+        result.checkpoints.extend(checkpoints)
+        result.positions.extend(positions)
+        if converged is None:
+            result.macros = state.macros
+            result.loaded_libraries = set(pobj.loaded_libraries)
+            result.py_exec_count = pobj.py_exec_count
+        return converged
+
+    def parse_pass(self, pobj, target, functions, document):
+        """Run a pass over the whole document.
+        @returns result(PassResult)"""
+        state = pobj.create_parser_state(target=target, functions=functions,
+                                         document=document)
+        if target == 'ctx' and self.preloaded is None:
+            for lib in self.preload_libs:
+                modules.PfLoadLibrary.load_library(pobj, state, lib)
+        result = PassResult(document)
+        self.run_pass(pobj, state, result)
+        return result
+
+    def reparse_pass(self, pobj, target, old, begin, end, text):
+        """Run a pass again over an edited document.
+        @param old(PassResult) previous run of this pass
+        @param begin, end(int) replaced range of old document
+        @param text(str) replacement
+        @returns result(PassResult), (begin, end, text) edit of output, or
+            None if unable to resume from a checkpoint"""
+        i = bisect.bisect_right(old.positions, begin) - 1
+        start = old.checkpoints[i]
+        # python functions may depend on calls made after the checkpoint
+        if old.py_exec_count != start.py_exec_count:
+            return None
+        document = old.document[:begin] + text + old.document[end:]
+        delta = len(text) - (end - begin)
+        state = pobj.create_parser_state(target=target, functions=start.macros,
+                                         document=document)
+        start.restore(pobj, state, old.positions[i])
+        result = PassResult(document)
+        result.checkpoints = old.checkpoints[:i]
+        result.positions = old.positions[:i]
+        result.segments = old.segments[:i]
+        j = self.run_pass(pobj, state, result, old=old,
+                          edit_end=begin + len(text), delta=delta, restart=i)
+        new_segments = result.segments[i:]
+        if j is None:
+            j = len(old.checkpoints)
+        else:
+            # the rest of previous run is valid
+            result.checkpoints.extend(old.checkpoints[j:])
+            result.positions.extend(pos + delta for pos in
+                                    old.positions[j:])
+            result.segments.extend(old.segments[j:])
+            result.macros = old.macros
+            result.loaded_libraries = old.loaded_libraries
+            result.py_exec_count = old.py_exec_count
+        out_begin = sum(len(s) for s in old.segments[:i])
+        out_end = out_begin + sum(len(s) for s in old.segments[i:j])
+        return result, (out_begin, out_end, ''.join(new_segments))
+
+    def parse(self, source):
+        """Convert the whole document.
+        @param source(str) document contents
+        @returns document(str) converted document"""
+        # every run of the whole document starts with fresh variables
+        if self.preloaded is not None:
+            self.context = self.preloaded.context.copy()
+            functions = self.preloaded.functions
+        else:
+            self.context = kernel.ParserContext()
+            functions = loader.make_default_functions()
+        pobj = self.make_parser(source)
+        pobj.extract_headers()
+        passes = [self.parse_pass(pobj, 'ctx', functions, pobj.document)]
+        if self.target != 'ctx':
+            passes.append(self.parse_pass(pobj, self.target,
+                                          passes[0].macros,
+                                          passes[0].get_output()))
+        self.source = source
+        self.header_end = get_header_end(source)
+        self.header_len = len(source) - len(pobj.document)
+        self.headers = pobj.headers
+        self.passes = passes
+        self.document = passes[-1].get_output()
+        self.dependencies = pobj.dependencies
+        return self.document
+
+    def update(self, begin, end, text):
+        """Replace source[begin:end] with text and convert the edited
+        document, reusing output of unaffected paragraphs.
+        @returns document(str) converted document"""
+        source = self.source[:begin] + text + self.source[end:]
+        try:
+            return self.reparse(source, begin, end, text)
+        except Exception:
+            # stay in step with the editor, the next update converts the
+            # whole document
+            self.source = source
+            self.passes = []
+            raise
+
+    def reparse(self, source, begin, end, text):
+        """Convert edited document, see update.
+        @param source(str) document after the edit
+        @returns document(str) converted document"""
+        if begin <= self.header_end or len(self.passes) == 0:
+            return self.parse(source)
+        self.context.start()
+        pobj = self.make_parser(source)
+        pobj.dependencies = dict(self.dependencies)
+        edit = (begin - self.header_len, end - self.header_len, text)
+        passes = []
+        for i, old in enumerate(self.passes):
+            target = 'ctx' if i == 0 else self.target
+            # later passes depend on macros defined in previous ones
+            if i > 0 and passes[0].macros.data is not \
+                    self.passes[0].macros.data:
+                res = None
+            else:
+                res = self.reparse_pass(pobj, target, old, *edit)
+            if res is None:
+                return self.parse(source)
+            result, edit = res
+            passes.append(result)
+        self.source = source
+        self.passes = passes
+        self.document = passes[-1].get_output()
+        self.dependencies = pobj.dependencies
+        return self.document
+    pass
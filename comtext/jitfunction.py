@@ -1,12 +1,15 @@
+import marshal
 
 from . import keywords
 from . import misc
 
 
+class UniversalVariableScope:
+    pass
+
+
 class UniversalVariableStorage:
     def initvar(self, scope, name, val):
-        class UniversalVariableScope:
-            pass
         if not hasattr(self, scope):
             setattr(self, scope, UniversalVariableScope())
         shandle = getattr(self, scope)
@@ -14,7 +17,6 @@ class UniversalVariableStorage:
             setattr(shandle, name, val)
         return
     pass
-universal_vars = UniversalVariableStorage()
 
 
 class JitFunctionPy:
@@ -60,38 +62,56 @@ class JitFunctionPy:
         self.function_name = function_name
         self.arguments = arguments
         self.code = code
-        # set global variables, default to None
-        self.globals = JitFunctionPy.GlobalVariableStorage()
         # create execution script
         script = 'def __function__(%s):\n' % ', '.join(arguments)\
-                 + '%s\n' % '\n'.join((' ' * 4 + i) for i in code.split('\n'))\
-                 + '__result__ = __function__(*__args__)'
+                 + '%s\n' % '\n'.join((' ' * 4 + i) for i in code.split('\n'))
         # compile script
         self.binary = compile(script, '<string>', 'exec')
         return
 
-    def eval(self, *args):
+    def make_function(self, universal_vars):
+        """Create the callable from compiled script, with global variables
+        of its own, default to None.
+        @param universal_vars(UniversalVariableStorage) shared with other
+            functions of the same conversion"""
+        globs = {
+            keywords.jit_py_globals_classname:
+                JitFunctionPy.GlobalVariableStorage(),
+            keywords.jit_py_universals_classname: universal_vars
+        }
+        exec(self.binary, globs)
+        return globs['__function__']
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['binary'] = marshal.dumps(self.binary)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.binary = marshal.loads(self.binary)
+        return
+
+    def eval(self, context, *args):
         """Execute function and returns result.
+        @param context(kernel.ParserContext) holds the variables the
+            function is run with
         @param *args positional arguments to call the dynamic function
         @returns ... depending on function behavior
         @throws TypeError when positional arguments' number doesn't match
         @throws ... depending on function behavior"""
-        JitFunctionPy.report_argument_cnt_mismatch(self.function_name,
-                                                   self.arguments, args)
-        # execute function
-        locals = {'__args__': args}
-        globs = {
-            keywords.jit_py_globals_classname: self.globals,
-            keywords.jit_py_universals_classname: universal_vars
-        }
-        exec(self.binary, globs, locals)
-        return locals['__result__']
+        if len(args) != len(self.arguments):
+            JitFunctionPy.report_argument_cnt_mismatch(self.function_name,
+                                                       self.arguments, args)
+        return context.get_py_function(self)(*args)
     pass
 
 
 class JitFunctionRaw:
     """Function wrapper that substitutes arguments starting with # chars."""
 
+    __slots__ = ('function_name', 'arguments', 'binary')
+
     def __init__(self, function_name, arguments, code):
         """Initialize dynamic function and compile code.
         @param function_name(str) function name
@@ -99,28 +119,24 @@ class JitFunctionRaw:
             must correspond to the ones used in the function
         @param code(str) subsitute string"""
         self.function_name = function_name
-        self.arguments = arguments
-        self.code = code
-        # stack tuples: (is_string_or_not, ...)
-        #   string:     (bool(True), str(code))
-        #   not string: (bool(False), int(argument_id))
-        stack = [(True, self.code)]
+        self.arguments = tuple(arguments)
+        # binary is a flat tuple of pieces:
+        #   string:     str(code)
+        #   not string: int(argument_id)
+        stack = [code]
         # split code with stack
         for i in range(0, len(self.arguments)):
             var = keywords.jit_raw_variable % self.arguments[i]
             new_stack = []
-            for is_string, data in stack:
-                if not is_string:
-                    new_stack.append((is_string, data))
+            for data in stack:
+                if data.__class__ is int:
+                    new_stack.append(data)
                     continue
-                strs = list((True, i) for i in data.split(var))
-                strs = misc.listjoin((False, i), strs)
-                for s in strs:
-                    if s != (True, ''):
+                for s in misc.listjoin(i, data.split(var)):
+                    if s != '':
                         new_stack.append(s)
             stack = new_stack
-        # update binary with this (somehow unreadable) format
-        self.binary = stack
+        self.binary = tuple(stack)
         return
 
     def eval(self, *args):
@@ -128,14 +144,15 @@ class JitFunctionRaw:
         @param *args positional arguments to call the dynamic function
         @returns output(str)
         @throws TypeError when positional arguments' number doesn't match"""
-        JitFunctionPy.report_argument_cnt_mismatch(self.function_name,
-                                                   self.arguments, args)
+        if len(args) != len(self.arguments):
+            JitFunctionPy.report_argument_cnt_mismatch(self.function_name,
+                                                       self.arguments, args)
         # substitute arguments
-        result = ''
-        for is_string, data in self.binary:
-            if is_string:
-                result += data
+        result = []
+        for data in self.binary:
+            if data.__class__ is str:
+                result.append(data)
             else:
-                result += str(args[data])
-        return result
+                result.append(str(args[data]))
+        return ''.join(result)
     pass
@@ -1,7 +1,12 @@
 
+import bisect
+import copy
 import re
+import time
 import yaml
 
+from . import cache
+from . import jitfunction
 from . import keywords
 from . import lang
 from . import misc
@@ -11,72 +16,147 @@ from . import trie
 from .error import ParserError
 
 
+class AutoBreakState:
+    """Paragraph state of the automatic line breaking."""
+
+    __slots__ = ('opened', 'space', 'breaks', 'm_b', 'm_e', 'enabled')
+
+    def __init__(self):
+        self.opened = False
+        self.space = False
+        self.breaks = 0
+        self.m_b = False
+        self.m_e = False
+        self.enabled = True
+        return
+    pass
+
+
+class MarkerIndex:
+    """Positions of the markers that scopes are closed with in a document:
+    scope ends, line breaks, and scope ends or environment ends leading a
+    line, which close definitions and environments. Built in one pass over
+    the document, so that the next marker is found by binary search instead
+    of searching through the document."""
+
+    line_marker_pattern = re.compile(r'\n *(?:%s|%s%s[^%s%s\n]*%s)' % (
+        re.escape(keywords.scope_end), re.escape(keywords.kw_environment_end),
+        re.escape(keywords.scope_begin), re.escape(keywords.scope_begin),
+        re.escape(keywords.scope_end), re.escape(keywords.scope_end)))
+
+    def __init__(self, document):
+        self.positions = {}  # marker -> sorted positions
+        for sub in [keywords.scope_end, '\n']:
+            self.positions[sub] = [m.start() for m in
+                                   re.finditer(re.escape(sub), document)]
+        for match in MarkerIndex.line_marker_pattern.finditer(document):
+            sub = match.group()
+            if sub not in self.positions:
+                self.positions[sub] = []
+            self.positions[sub].append(match.start())
+        return
+
+    def find(self, document, sub, begin):
+        """Find position of next occurence of sub starting from begin.
+        @param document(str) the document this index is built from
+        @returns res(int) -1 if failure"""
+        positions = self.positions.get(sub, None)
+        if positions is None:
+            return document.find(sub, begin)
+        i = bisect.bisect_left(positions, begin)
+        if i < len(positions):
+            return positions[i]
+        return -1
+    pass
+
+
 class ParserState:
     """Stores the current state of the parser."""
 
+    # many states are alive at once while nesting, slots keep them small
+    __slots__ = ('pos', 'target', 'depth', 'exec_count', 'autobreak',
+                 'filepath', 'filename', '_document', '_line_starts',
+                 '_markers', 'macros', 'checkpoint')
+
     def __init__(self):
-        # location definition
-        self.row = 0
-        self.col = 0
+        # location definition, row and column are derived from pos on demand
         self.pos = 0
         # parser stack data
         self.target = ''  # 'web' or 'doc'
         self.depth = 0  # recursion depth
         self.exec_count = 0  # executed function count
-        self.autobreak = misc.DictObject(
-            opened=False,
-            space=False,
-            breaks=0,
-            m_b=False,
-            m_e=False,
-            enabled=True
-        )
+        self.autobreak = AutoBreakState()
         # file properties
         self.filepath = ''
         self.filename = ''
         self.document = ''
         # non-builtin macros
         self.macros = trie.Trie()
+        # called with this state at paragraph breaks of the top-level block,
+        # where the state only depends on the document before this position
+        self.checkpoint = None
+        return
+
+    @property
+    def document(self):
+        return self._document
+
+    @document.setter
+    def document(self, document):
+        self._document = document
+        self._line_starts = None  # built upon first row / col query
+        self._markers = None  # built upon first search for a marker
         return
 
+    def get_line_starts(self):
+        """Get offsets of every line beginning in document, the index is only
+        built once per document.
+        @returns line_starts(list(int))"""
+        if self._line_starts is None:
+            self._line_starts = misc.get_line_starts(self._document)
+        return self._line_starts
+
+    def get_marker_index(self):
+        """Get positions of scope end markers in document, the index is only
+        built once per document.
+        @returns markers(MarkerIndex)"""
+        if self._markers is None:
+            self._markers = MarkerIndex(self._document)
+        return self._markers
+
+    @property
+    def row(self):
+        """Row of current position, starting from 0."""
+        return bisect.bisect_right(self.get_line_starts(), self.pos) - 1
+
+    @property
+    def col(self):
+        """Column of current position, starting from 0."""
+        line_starts = self.get_line_starts()
+        row = bisect.bisect_right(line_starts, self.pos) - 1
+        return self.pos - line_starts[row]
+
     def shift_forward(self, ch):
         """Shift position markers forward at character.
         @param ch(str[0]) character at current position"""
-        self.col += 1
-        if ch == '\n':
-            self.row += 1
-            self.col = 0
         self.pos += 1
         return
 
     def shift_forward_mul(self, text):
         """Shift position markers forward at multiple characters.
         @param text(str) multiple characters"""
-        for i in text:
-            self.shift_forward(i)
+        self.pos += len(text)
         return
 
     def shift_to_end(self):
-        """Shift to document end.
-        @param text(str) entire document"""
-        begin = self.pos
-        text = self.document
-        for i in range(begin, len(text)):
-            self.shift_forward(text[i])
+        """Shift to document end."""
+        self.pos = len(self.document)
         return
 
     def shift_backward(self, dist):
-        text = self.document
-        for i in range(0, dist):
-            self.pos -= 1
-            self.col -= 1
-            if text[i] == '\n':
-                self.row -= 1
-        self.col = 1
-        for i in range(self.pos, -1, -1):
-            if text[i] == '\n':
-                break
-            self.col += 1
+        """Shift position markers backward.
+        @param dist(int) number of characters"""
+        self.pos = max(self.pos - dist, 0)
         return
 
     def add_function(self, function_name, function):
@@ -98,10 +178,102 @@ class ParserState:
     pass
 
 
+class ParserContext:
+    """Variables of one conversion, which Python functions keep between
+    calls. Shared by the parsers of a document and the libraries it loads,
+    and not by other conversions, which may run at the same time."""
+
+    # functions called between checks of the clock
+    time_check_interval = 256
+
+    def __init__(self):
+        self.universal_vars = jitfunction.UniversalVariableStorage()
+        # jitfunction.JitFunctionPy -> callable with variables of its own
+        self.py_functions = {}
+        self.blob_sites = []  # calling states of the outputs being parsed
+        self.start()
+        return
+
+    def start(self, limits=None):
+        """Reset the cost of the conversion and start its clock.
+        @param limits(dict/None) overrides keywords.limit_*, keys are
+            'depth', 'expansions', 'blob_scans' and 'time'"""
+        self.limits = {
+            'depth': keywords.limit_depth,
+            'expansions': keywords.limit_expansions,
+            'blob_scans': keywords.limit_blob_scans,
+            'time': keywords.limit_time,
+        }
+        if limits is not None:
+            for key in limits:
+                if key not in self.limits:
+                    raise ValueError(key)
+            self.limits.update(limits)
+        self.max_depth = self.limits['depth']
+        if self.max_depth is None:
+            self.max_depth = float('inf')
+        self.deadline = None
+        if self.limits['time'] is not None:
+            self.deadline = time.monotonic() + self.limits['time']
+        self.calls = 0  # functions called
+        self.blob_scans = 0
+        self.schedule_check()
+        return
+
+    def schedule_check(self):
+        """Set the number of calls at which limits are checked next."""
+        self.next_check = float('inf')
+        if self.limits['expansions'] is not None:
+            self.next_check = self.limits['expansions'] + 1
+        if self.deadline is not None:
+            self.next_check = min(self.next_check, self.calls +
+                                  ParserContext.time_check_interval)
+        return
+
+    def get_py_function(self, func):
+        """Get callable of a Python function, bound to variables of this
+        conversion.
+        @param func(jitfunction.JitFunctionPy)"""
+        res = self.py_functions.get(func, None)
+        if res is None:
+            res = func.make_function(self.universal_vars)
+            self.py_functions[func] = res
+        return res
+
+    def copy(self):
+        """Create a context holding copies of the universal variables, in
+        which functions start with fresh variables of their own.
+        @returns context(ParserContext)"""
+        res = copy.copy(self)
+        res.universal_vars = copy.deepcopy(self.universal_vars)
+        res.py_functions = {}
+        res.blob_sites = []
+        return res
+
+    def __getstate__(self):
+        # functions are bound again on first use
+        state = dict(self.__dict__)
+        state['py_functions'] = {}
+        return state
+    pass
+
+
+class ParserPause(Exception):
+    """Raised at a checkpoint to suspend parsing, which continues when the
+    same state is parsed again."""
+    pass
+
+
 class Parser:
     """Document parser class"""
 
-    def __init__(self, filepath, filename, document, target, include_path=[]):
+    auto_break_split = re.compile(r'([ \n]+)')
+    trigger_patterns = {}  # leading characters -> compiled pattern
+    # front matter loader, libyaml's if installed
+    yaml_loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+    def __init__(self, filepath, filename, document, target, include_path=[],
+                 library_cache=None, context=None):
         self.filepath = filepath
         self.filename = filename
         self.include_path = include_path
@@ -111,6 +283,17 @@ class Parser:
         self.source = document  # original, unmodified document
         self.target = target
         self.loaded_libraries = set()
+        self.dependencies = {}  # absolute path -> content hash of libraries
+        self.library_cache = library_cache  # cache.LibraryCache or None
+        self.py_exec_count = 0  # executed python functions
+        # variables of python functions, see ParserContext
+        self.context = context if context is not None else ParserContext()
+        self.pure_cache = cache.ResultCache(keywords.func_pure_cache_size)
+        self.profiler = None  # profiler.Profiler, records function costs
+        # (function, macros) -> if running it keeps macros, see check_scopes
+        self.checked_expansions = {}
+        # (parser, state) of other targets sharing the first pass
+        self.companions = []
         return
 
     def get_current_indent(self, state):
@@ -165,6 +348,33 @@ class Parser:
             return (ab.m_e + ab.m_b) * s + ch
         return ch
 
+    def process_auto_break_run(self, state, text):
+        """Auto break utility for a run of characters that leads no function,
+        returns inserted string (buffer). Equivalent to feeding every
+        character to process_auto_break.
+        @param state(ParserState)
+        @param text(str) the run of characters"""
+        ab = state.autobreak
+        output = []
+        for chunk in Parser.auto_break_split.split(text):
+            if chunk == '':
+                continue
+            ch = chunk[0]
+            if ch != ' ' and ch != '\n':
+                # only the first character may produce breaks or spaces
+                output.append(self.process_auto_break(state, ch))
+                output.append(chunk[1:])
+                continue
+            if not ab.opened:
+                continue
+            breaks = chunk.count('\n')
+            if breaks > 0:
+                ab.space = True
+                ab.breaks += breaks
+            elif ab.breaks == 0:
+                ab.space = True
+        return ''.join(output)
+
     def open_auto_break(self, state, reopen=False):
         if state.autobreak.opened:
             return ''
@@ -205,26 +415,33 @@ class Parser:
         @param state(ParserState)
         @param begin(int) position of match begin
         @returns func(str) function name, '' if none matches"""
-        p = state.macros.root
-        func = ''
-        cur_str = ''
-        for i in range(begin, len(state.document)):
-            ch = state.document[i]
-            if ch not in p.children:
-                break
-            cur_str += ch
-            p = p.children[ch]
-            if p.flag is not None:
-                func = cur_str
-            pass
-        return func
+        return state.macros.match(state.document, begin)
+
+    def get_trigger_pattern(self, state, end_marker=None):
+        """Get pattern matching characters that may lead a function or the
+        end marker, anything else can be passed to output as a whole.
+        @param state(ParserState)
+        @param end_marker(str/None)
+        @returns pattern(re.Pattern)"""
+        chars = state.macros.get_leading_chars()
+        if end_marker is not None:
+            chars += end_marker[:1]
+        pattern = Parser.trigger_patterns.get(chars, None)
+        if pattern is None:
+            if chars == '':
+                pattern = re.compile(r'(?!)')
+            else:
+                pattern = re.compile('[%s]' % ''.join(re.escape(i)
+                                                      for i in chars))
+            Parser.trigger_patterns[chars] = pattern
+        return pattern
 
     def match_next_keyword(self, state, begin, sub):
         """Match position of next occurence of sub starting from begin.
         @param begin(int)
         @param sub(str)
         @returns res(int) -1 if failure"""
-        return state.document.find(sub, begin)
+        return state.get_marker_index().find(state.document, sub, begin)
 
     def match_to_next_occurence(self, state, sub, sub_display_error=None):
         """Match until next occurence of ...sub.
@@ -246,9 +463,7 @@ class Parser:
     def match_verbatim_scope(self, state):
         """Match immediate {...} and return contents.
         @param state(ParserState)"""
-        m_begin = self.match_next_keyword(state, state.pos,
-                                          keywords.scope_begin)
-        if m_begin != state.pos:
+        if not state.document.startswith(keywords.scope_begin, state.pos):
             err_msg = lang.text('Parser.Error.Scope.ExpectedBeginMarker') %\
                                 keywords.scope_begin
             raise ParserError({'row': state.row, 'col': state.col, 'file':
@@ -260,78 +475,189 @@ class Parser:
     def match_parsable_scope(self, state):
         """Match {...} and return parsed contents.
         @param state(ParserState)"""
-        m_begin = self.match_next_keyword(state, state.pos,
-                                          keywords.scope_begin)
-        if m_begin != state.pos:
+        if not state.document.startswith(keywords.scope_begin, state.pos):
+            err_msg = lang.text('Parser.Error.Scope.ExpectedBeginMarker') %\
+                                keywords.scope_begin
+            raise ParserError({'row': state.row, 'col': state.col, 'file':
+                               state.filename, 'path': state.filepath,
+                               'cause': err_msg})
+        state.shift_forward_mul(keywords.scope_begin)
+        return self.parse_block(state, end_marker=keywords.scope_end)
+
+    def check_parsable_scope(self, state):
+        """Move past immediate {...} the way match_parsable_scope does,
+        without running any function.
+        @param state(ParserState)
+        @returns bool False if the rest of the document cannot be checked"""
+        if not state.document.startswith(keywords.scope_begin, state.pos):
             err_msg = lang.text('Parser.Error.Scope.ExpectedBeginMarker') %\
                                 keywords.scope_begin
             raise ParserError({'row': state.row, 'col': state.col, 'file':
                                state.filename, 'path': state.filepath,
                                'cause': err_msg})
+        begin = state.pos
         state.shift_forward_mul(keywords.scope_begin)
-        state.depth += 1
-        res = self.parse_block(state, end_marker=keywords.scope_end)
-        state.depth -= 1
+        res = self.check_block(state, end_marker=keywords.scope_end)
+        if res is None:
+            state.pos = begin
+            err_msg = lang.text('Parser.Error.Scope.Unclosed') %\
+                keywords.scope_begin
+            raise ParserError({'row': state.row, 'col': state.col, 'file':
+                               state.filename, 'path': state.filepath,
+                               'cause': err_msg})
         return res
 
-    def extract_headers(self):
-        """Extract headers and generate preprocessed document."""
-        lines = self.document.split('\n')
-        # preproocess document headers
-        self.headers = {}
-        n_header_begin = 0  # first non-empty line
-        n_header_end = 0  # header end
-        for i in range(0, len(lines)):
-            if lines[i].strip() != '':
+    def check_block(self, state, end_marker=None):
+        """Move past document portion the way parse_block does, matching
+        functions and their arguments without running them, so that
+        misplaced scope markers are reported before any function is run.
+        @param state(ParserState) current state
+        @param end_marker(str/None) terminates until this is found.
+        @returns res(bool/None) False if the rest of the document cannot be
+            checked, as it depends on running functions, None if the
+            document ends before end_marker"""
+        document = state.document
+        trigger = None
+        while True:
+            if trigger is None:
+                trigger = self.get_trigger_pattern(state, end_marker)
+            match = trigger.search(document, state.pos)
+            if match is None:
                 break
-            n_header_begin += 1
-        # process header if exists
-        if re.match(keywords.header_marker_begin, lines[i]) is not None:
-            # locate header end
-            for i in range(n_header_begin + 1, len(lines)):
-                if re.match(keywords.header_marker_end, lines[i]) is not None:
-                    n_header_end = i
+            pos = match.start()
+            if end_marker is not None and \
+                    document.startswith(end_marker, pos):
+                state.pos = pos + len(end_marker)
+                return True
+            func_name = state.macros.match(document, pos)
+            if func_name == '':
+                state.pos = pos + 1
+                continue
+            state.pos = pos + len(func_name)
+            func = state.get_function_by_name(func_name)
+            state.depth += 1
+            if state.depth > self.context.max_depth:
+                self.check_limits(state, func_name)
+            try:
+                if not func.check(self, state):
+                    return False
+            except RecursionError:
+                self.report_recursion(state, func_name)
+            state.depth -= 1
+            # functions may have altered the macros
+            trigger = None
+        state.shift_to_end()
+        if end_marker is not None:
+            return None
+        return True
+
+    def check_scopes(self, state):
+        """Report misplaced scope markers in the document of state before
+        parsing it. Functions defined by the document are taken into
+        account, the state itself is left unchanged.
+        @param state(ParserState) state of the first pass
+        @throws ParserError"""
+        cstate = self.create_parser_state(target=state.target,
+                                          functions=state.macros,
+                                          document=state.document)
+        cstate.pos = state.pos
+        cstate._markers = state.get_marker_index()
+        try:
+            self.check_block(cstate)
+        finally:
+            self.checked_expansions = {}
+        return
+
+    @staticmethod
+    def read_headers(lines, filepath, filename):
+        """Parse the front matter at the beginning of a document, taking
+        lines only as far as its end marker.
+        @param lines(iter(str)) lines of document without line breaks
+        @returns headers(dict) contents of front matter, {} if none
+        @returns rows(range) rows taken up by front matter and its markers"""
+        head = []
+        n_header_begin = None  # begin marker
+        row = 0
+        for row, line in enumerate(lines):
+            if n_header_begin is None:
+                # skip leading empty lines
+                if line.strip() == '':
+                    continue
+                if re.match(keywords.header_marker_begin, line) is None:
                     break
-            # if header end does not exists, report error
-            if n_header_end == 0:
-                err_msg = lang.text('Parser.Error.Header.Unterminated')
-                raise ParserError({'row': len(lines)-1, 'col': 0, 'file':
-                                   self.filename, 'path': self.filepath,
-                                   'cause': err_msg})
+                n_header_begin = row
+                continue
+            if re.match(keywords.header_marker_end, line) is None:
+                head.append(line)
+                continue
             # process header entries
-            head_src = '\n'.join(lines[:n_header_end][(n_header_begin + 1):])
             try:
-                self.headers = yaml.load(head_src)
+                headers = yaml.load('\n'.join(head),
+                                    Loader=Parser.yaml_loader)
             except Exception as err:
                 err_msg = lang.text('Parser.Error.Header.ParseError') %\
                           str(err)
-                raise ParserError({'row': n_header_end, 'col': 0, 'file':
-                                   self.filename, 'path': self.filepath,
-                                   'cause': err_msg})
-            # clear header from range
-            for i in range(n_header_begin, n_header_end + 1):
-                lines[i] = ''
-        # build dom tree
-        self.document = '\n'.join(lines)
+                raise ParserError({'row': row, 'col': 0, 'file': filename,
+                                   'path': filepath, 'cause': err_msg})
+            return headers, range(n_header_begin, row + 1)
+        # if header end does not exists, report error
+        if n_header_begin is not None:
+            err_msg = lang.text('Parser.Error.Header.Unterminated')
+            raise ParserError({'row': row, 'col': 0, 'file': filename,
+                               'path': filepath, 'cause': err_msg})
+        return {}, range(0)
+
+    def extract_headers(self):
+        """Extract headers and generate preprocessed document."""
+        self.headers, rows = Parser.read_headers(
+            misc.iter_lines(self.document), self.filepath, self.filename)
+        # clear header from range
+        if len(rows) > 0:
+            begin = misc.get_line_offset(self.document, rows.start)
+            end = misc.get_line_offset(self.document, rows.stop) - 1
+            self.document = self.document[:begin] + '\n' * (len(rows) - 1) +\
+                self.document[end:]
         return
 
-    def parse_block(self, state, end_marker=None):
+    def parse_block(self, state, end_marker=None, output=None):
         """Convert document portion to a certain output format.
         @param state(ParserState) current state
-        @param end_marker(str/None) terminates until this is found."""
-        output = ''
+        @param end_marker(str/None) terminates until this is found.
+        @param output(OutputBuilder/file/None) text stream receiving output
+        @returns output(str) converted text, '' if output stream is given"""
+        if output is None:
+            builder = misc.OutputBuilder()
+        else:
+            builder = output
+        write = builder.write
+        context = self.context
         has_end_marker = False
+        trigger = None
         while state.pos < len(state.document):
+            # skip to the next character that may lead a function
+            if trigger is None:
+                trigger = self.get_trigger_pattern(state, end_marker)
+            match = trigger.search(state.document, state.pos)
+            run_end = match.start() if match is not None else \
+                len(state.document)
+            if run_end > state.pos:
+                # stop at paragraph breaks if checkpoints are recorded
+                at_checkpoint = False
+                if state.checkpoint is not None and end_marker is None:
+                    para_end = state.document.find('\n\n', state.pos, run_end)
+                    if para_end != -1:
+                        run_end = para_end + 2
+                        at_checkpoint = True
+                run = state.document[state.pos:run_end]
+                write(self.process_auto_break_run(state, run))
+                state.shift_forward_mul(run)
+                if at_checkpoint:
+                    state.checkpoint(state)
+                continue
             ch = state.document[state.pos]
             # check if end marker occured, only if there is an end marker
             if end_marker is not None:
-                flag_end = True
-                for i in range(state.pos, min(len(state.document),
-                               state.pos + len(end_marker))):
-                    if state.document[i] != end_marker[i - state.pos]:
-                        flag_end = False
-                        break
-                if flag_end is True:
+                if state.document.startswith(end_marker, state.pos):
                     state.shift_forward_mul(end_marker)
                     has_end_marker = True
                     break
@@ -339,18 +665,32 @@ class Parser:
             func_name = self.match_function(state, state.pos)
             # no function matches
             if func_name == '':
-                output += self.process_auto_break(state, ch)
+                write(self.process_auto_break(state, ch))
                 state.shift_forward(ch)
                 continue
             else:
                 state.shift_forward_mul(func_name)
             # parse function scope
             func = state.get_function_by_name(func_name)
+            if len(self.companions) > 0:
+                self.match_companions(state, func_name, func)
             state.depth += 1
-            tmp = func.parse(self, state)
+            context.calls += 1
+            if state.depth > context.max_depth or \
+                    context.calls >= context.next_check:
+                self.check_limits(state, func_name)
+            try:
+                if self.profiler is None:
+                    tmp = func.parse(self, state)
+                else:
+                    tmp = self.profiler.call(func_name, func, self, state)
+            except RecursionError:
+                self.report_recursion(state, func_name)
             state.depth -= 1
             state.exec_count += 1
-            output += tmp
+            write(tmp)
+            # functions may have altered the macros
+            trigger = None
         # expected end marker but none found
         if end_marker is not None and not has_end_marker:
             err_msg = lang.text('Parser.Error.Scope.ExpectedEndMarker') %\
@@ -359,21 +699,86 @@ class Parser:
                                state.filename, 'path': state.filepath,
                                'cause': err_msg})
         # finally
-        return output
+        if output is not None:
+            return ''
+        return builder.getvalue()
 
-    def parse_blob(self, state, blob):
-        """Completely eradicate all functions in scope."""
-        while True:
-            ns = self.create_parser_state(state.target, state.macros,
-                                          document=blob)
-            ns.autobreak.enabled = False
-            before = ns.exec_count
+    def check_limits(self, state, func_name):
+        """Raise if the conversion went beyond any of its limits, reported
+        at the function called from the document that caused it.
+        @param func_name(str) function being called
+        @throws ParserError"""
+        context = self.context
+        limits = context.limits
+        err_msg = None
+        if state.depth > context.max_depth:
+            err_msg = lang.text('Parser.Error.Limit.Depth') % \
+                (func_name, limits['depth'])
+        elif limits['expansions'] is not None and \
+                context.calls > limits['expansions']:
+            err_msg = lang.text('Parser.Error.Limit.Expansions') % \
+                (func_name, limits['expansions'])
+        elif limits['blob_scans'] is not None and \
+                context.blob_scans > limits['blob_scans']:
+            err_msg = lang.text('Parser.Error.Limit.BlobScans') % \
+                (func_name, limits['blob_scans'])
+        elif context.deadline is not None and \
+                time.monotonic() > context.deadline:
+            err_msg = lang.text('Parser.Error.Limit.Time') % \
+                (func_name, limits['time'])
+        if err_msg is None:
+            context.schedule_check()
+            return
+        self.report_limit(state, err_msg)
+        return
+
+    def report_recursion(self, state, func_name):
+        """Raise in place of running out of interpreter stack, which may
+        happen before the depth limit is reached.
+        @param func_name(str) function being called
+        @throws ParserError"""
+        err_msg = lang.text('Parser.Error.Limit.Stack') % func_name
+        self.report_limit(state, err_msg)
+        return
+
+    def report_limit(self, state, err_msg):
+        """Raise error on a limit, at the function called from the document
+        that went beyond it.
+        @throws ParserError"""
+        if len(self.context.blob_sites) > 0:
+            state = self.context.blob_sites[0]
+        raise ParserError({'row': state.row, 'col': state.col - 1, 'file':
+                           state.filename, 'path': state.filepath,
+                           'cause': err_msg})
+
+    def parse_blob(self, state, blob, func_name=''):
+        """Completely eradicate all functions in scope. Output of functions
+        called in blob has already been expanded by the time they return,
+        so a single scan leaves no functions to execute; scanning the
+        output again would only emit escaped characters once more.
+        @param state(ParserState) state of the calling function
+        @param blob(str) output of the calling function
+        @param func_name(str) name of the calling function
+        @returns blob(str) expanded output"""
+        if self.profiler is not None:
+            self.profiler.add_blob(blob)
+        context = self.context
+        context.blob_scans += 1
+        limit = context.limits['blob_scans']
+        if limit is not None and context.blob_scans > limit:
+            self.check_limits(state, func_name)
+        ns = self.create_parser_state(state.target, state.macros,
+                                      document=blob)
+        ns.autobreak.enabled = False
+        # nesting goes on within the output
+        ns.depth = state.depth
+        context.blob_sites.append(state)
+        try:
             blob = self.parse_document(ns)
-            after = ns.exec_count
-            state.macros = ns.macros
-            state.exec_count += ns.exec_count
-            if before == after:
-                break
+        finally:
+            context.blob_sites.pop()
+        state.macros = ns.macros
+        state.exec_count += ns.exec_count
         return blob
 
     def create_parser_state(self, target, functions, document=None,
@@ -381,8 +786,6 @@ class Parser:
         """Create initial parser state for parsing."""
         state = ParserState()
         # initialize basic parameters
-        state.row = 0
-        state.col = 0
         state.pos = 0
         state.target = target
         state.depth = 0
@@ -398,36 +801,264 @@ class Parser:
         }.get(state.target, '')
         state.filepath = self.filepath
         state.filename = self.filename
-        # load initial functions
-        for i in functions:
-            state.add_function(i, functions[i])
+        # load initial functions, shared until modified
+        state.macros = functions.copy()
         # load document
         if document is None:
             state.document = self.document
         else:
             state.document = document
         # set break state
-        if break_enabled is None:
-            state.autobreak.break_enabled = True
-        else:
-            state.autobreak.break_enabled = break_enabled
+        if break_enabled is not None:
+            state.autobreak.enabled = break_enabled
         return state
 
-    def parse_document(self, state):
-        """Convert arbitrary document to a certain output format."""
+    def parse_document(self, state, output=None):
+        """Convert arbitrary document to a certain output format.
+        @param output(OutputBuilder/file/None) text stream receiving output
+        @returns output(str) converted text, '' if output stream is given"""
+        if output is None:
+            builder = misc.OutputBuilder()
+        else:
+            builder = output
         # preprocess document
-        d = self.parse_block(state)
-        d += self.close_auto_break(state)
-        return d
+        self.parse_block(state, output=builder)
+        builder.write(self.close_auto_break(state))
+        if output is not None:
+            return ''
+        return builder.getvalue()
+
+    @staticmethod
+    def get_py_functions(functions):
+        """Get compiled python functions among the macros.
+        @param functions(trie.Trie) macros
+        @returns py_functions(list(jitfunction.JitFunctionPy))"""
+        py_functions = []
+        for name in functions:
+            func = functions[name]
+            if isinstance(func, (modules.PfDynamicFunction,
+                                 modules.PfDynamicEnvironment)) and \
+                    func.py_func is not None:
+                py_functions.append(func.py_func)
+        return py_functions
+
+    def pause_at_checkpoint(self, state):
+        raise ParserPause()
+
+    def parse_until_checkpoint(self, state, output):
+        """Parse top-level block until the next paragraph break.
+        @param state(ParserState) current state
+        @param output(OutputBuilder/file) text stream receiving output
+        @returns paused(bool) False if end of document is reached"""
+        state.checkpoint = self.pause_at_checkpoint
+        try:
+            self.parse_block(state, output=output)
+        except ParserPause:
+            return True
+        finally:
+            state.checkpoint = None
+        return False
+
+    def parse_stream(self, state, text, final):
+        """Append text to the document of a pass and convert it as far as
+        the last paragraph break that the conversion reaches at the top
+        level. The rest is parsed again when more text arrives.
+        @param state(ParserState) state of the pass, at a paragraph break
+        @param text(str) more input of the pass
+        @param final(bool) if text finishes the input
+        @returns output(list(str)) converted text by paragraph
+        @returns complete(bool) if the document has been converted up to
+            its end"""
+        state.document = state.document[state.pos:] + text
+        state.pos = 0
+        builder = misc.OutputBuilder()
+        output = []
+        while True:
+            ab = state.autobreak
+            saved = (state.pos, state.depth, state.exec_count, state.macros,
+                     ab.opened, ab.space, ab.breaks, ab.enabled)
+            state.macros = state.macros.copy()
+            try:
+                paused = self.parse_until_checkpoint(state, builder)
+            except ParserError:
+                if final:
+                    raise
+                paused = False
+            if not paused:
+                break
+            output.append(builder.getvalue())
+            del builder.chunks[:]
+        if final:
+            builder.write(self.close_auto_break(state))
+            output.append(builder.getvalue())
+            return output, True
+        # the last paragraph may be incomplete, revert to its beginning
+        complete = state.pos == saved[0]
+        state.pos, state.depth, state.exec_count, state.macros, \
+            ab.opened, ab.space, ab.breaks, ab.enabled = saved
+        return output, complete
+
+    def parse_iter(self, functions, preload_libs=[]):
+        """Parse this certain document, yielding converted text as soon as
+        each paragraph at the top level has been converted. The target pass
+        follows right behind the first pass with the macros defined so far,
+        which only differs from parse() if a macro is redefined after being
+        used. Documents with python functions in the target pass, which may
+        not be parsed twice, are converted by the target pass only after
+        the first pass has finished.
+        @returns generator(str) converted text"""
+        self.extract_headers()
+        state = self.create_parser_state(target='ctx',
+                                         functions=functions,
+                                         document=self.document)
+        for lib in preload_libs:
+            modules.PfLoadLibrary.load_library(self, state, lib)
+        self.check_scopes(state)
+        builder = misc.OutputBuilder()
+        tstate = None
+        if self.target != 'ctx':
+            tstate = self.create_parser_state(target=self.target,
+                                              functions=state.macros,
+                                              document='')
+        pending = ''  # first pass output not yet given to the target pass
+        waiting = 0  # unconverted length that has failed to convert
+        has_py_functions = False
+        while True:
+            paused = self.parse_until_checkpoint(state, builder)
+            if not paused:
+                builder.write(self.close_auto_break(state))
+            text = builder.getvalue()
+            del builder.chunks[:]
+            if tstate is None:
+                if text != '':
+                    yield text
+                if not paused:
+                    break
+                continue
+            pending += text
+            if tstate.macros.data is not state.macros.data:
+                tstate.macros = state.macros.copy()
+                has_py_functions = len(self.get_py_functions(
+                    state.macros)) > 0
+            # text after the last paragraph break is not complete yet, and
+            # failed attempts are only retried when the input has doubled
+            cut = pending.rfind('\n\n') + 2 if paused else len(pending)
+            if paused and (cut < 2 or cut < waiting or has_py_functions):
+                continue
+            output, complete = self.parse_stream(tstate, pending[:cut],
+                                                 final=not paused)
+            pending = pending[cut:]
+            waiting = 0 if complete else len(tstate.document) - tstate.pos
+            for text in output:
+                if text != '':
+                    yield text
+            if not paused:
+                break
+        self.state = tstate if tstate is not None else state
+        return
+
+    def parse_to(self, fileobj, functions, preload_libs=[]):
+        """Parse this certain document, writing converted text to fileobj as
+        soon as each paragraph at the top level has been converted.
+        @param fileobj(file) text stream receiving output"""
+        for text in self.parse_iter(functions, preload_libs=preload_libs):
+            fileobj.write(text)
+        return
+
+    def update_companions(self, update):
+        """Apply a change of functions to the other targets sharing the first
+        pass, leaving out those it fails for.
+        @param update(function(Parser, ParserState)) change to apply"""
+        for companion in list(self.companions):
+            try:
+                update(*companion)
+            except ParserError:
+                self.companions.remove(companion)
+        return
+
+    def match_companions(self, state, func_name, func):
+        """Leave out the other targets sharing the first pass that would have
+        matched another function, or one of another signature, here.
+        @param func_name(str) function name just matched, ending at pos"""
+        begin = state.pos - len(func_name)
+        signature = func.get_signature()
+        for companion in list(self.companions):
+            macros = companion[1].macros
+            other = macros.find(func_name)
+            if other is None or other.get_signature() != signature or \
+                    macros.match(state.document, begin) != func_name:
+                self.companions.remove(companion)
+        return
+
+    def parse_shared(self, functions, preload_libs=[], targets=[]):
+        """Parse the first pass of this document once for several targets.
+        Functions of every target are kept apart, and targets for which the
+        first pass would have given another output are left out.
+        @param functions(Trie) initial functions
+        @param targets(list(str)) targets besides self.target
+        @returns passes(dict(str, (Parser, Trie))) parser and functions for
+            the second pass of every target left
+        @returns document(str) output of the first pass"""
+        self.extract_headers()
+        state = self.create_parser_state(target='ctx',
+                                         functions=functions,
+                                         document=self.document)
+        for lib in preload_libs:
+            modules.PfLoadLibrary.load_library(self, state, lib)
+        companions = []
+        for target in targets:
+            cparser = Parser(filepath=self.filepath,
+                             filename=self.filename,
+                             document=self.document,
+                             target=target,
+                             include_path=self.include_path,
+                             library_cache=self.library_cache)
+            cparser.headers = self.headers
+            cstate = cparser.create_parser_state(target='ctx',
+                                                 functions=functions,
+                                                 document='')
+            for lib in preload_libs:
+                modules.PfLoadLibrary.load_library(cparser, cstate, lib)
+            companions.append((cparser, cstate))
+        self.check_scopes(state)
+        self.companions = companions
+        try:
+            document = self.parse_document(state)
+        finally:
+            companions, self.companions = self.companions, []
+        passes = {self.target: (self, state.macros)}
+        for cparser, cstate in companions:
+            # as if the first pass had been run for this target alone
+            cparser.context = self.context.copy()
+            passes[cparser.target] = (cparser, cstate.macros)
+        return passes, document
+
+    def parse_target(self, functions, document):
+        """Parse the second pass of this document, see parse_shared.
+        @param functions(Trie) functions left by the first pass
+        @param document(str) output of the first pass
+        @returns document(str) converted document"""
+        self.document = document
+        if self.target != 'ctx':
+            state = self.create_parser_state(target=self.target,
+                                             functions=functions,
+                                             document=document)
+            self.document = self.parse_document(state)
+            self.state = state
+        return self.document
 
-    def parse(self, functions, preload_libs=[]):
-        """Parse this certain document."""
+    def parse(self, functions, preload_libs=[], check=True):
+        """Parse this certain document.
+        @param check(bool) report misplaced scope markers before running any
+            function, see check_scopes"""
         self.extract_headers()
         state = self.create_parser_state(target='ctx',
                                          functions=functions,
                                          document=self.document)
         for lib in preload_libs:
             modules.PfLoadLibrary.load_library(self, state, lib)
+        if check:
+            self.check_scopes(state)
         self.document = self.parse_document(state)
         if self.target != 'ctx':
             state = self.create_parser_state(target=self.target,
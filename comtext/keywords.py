@@ -1,11 +1,22 @@
 
 # basic specifications
+ctx_version = '0.1.0'
+ctx_cache_version = 5  # changes along with attributes of cached functions
 ctx_file_extensions = [
     'ctx',
     'tex',
     'sty',
 ]
 ctx_file_encoding = 'utf-8'
+ctx_document_extensions = [
+    'ctx',
+]
+ctx_output_extensions = {
+    'ctx': 'ctx',
+    'doc': 'tex',
+    'web': 'html',
+}
+ctx_depfile_extension = 'd'  # appended to output path
 ctx_include_path = [
     '.',
 ]
@@ -36,6 +47,8 @@ kw_dyn_function = ch_escape + '%s'
 kw_dyn_environment_begin = kw_environment_begin + scope_begin + '%s' +\
                            scope_end
 kw_dyn_environment_end = kw_environment_end + scope_begin + '%s' + scope_end
+# functions that add to the macros
+kw_macro_defs = [kw_load_library, kw_def_function, kw_def_environment]
 
 # function related
 func_def_marker = ':'
@@ -65,6 +78,16 @@ func_brk = {
     func_brk_wrapinblk,
     func_brk_leaveblk,
 }
+func_opt_pure = 'pure'  # result only depends on arguments
+func_pure_cache_size = 4096  # results of pure functions kept per document
+output_cache_size = 64 * 1024 * 1024  # bytes of converted documents kept
+library_index_interval = 1.0  # seconds between checks of library folders
+
+# limits on the cost of a single conversion, None for no limit
+limit_depth = None  # functions called within arguments or output of others
+limit_expansions = 10000000  # functions called
+limit_blob_scans = 1000000  # outputs of functions parsed again
+limit_time = None  # seconds
 
 # jit function related
 jit_py_globals_classname = 'glob'
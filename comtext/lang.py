@@ -16,6 +16,8 @@ class LanguageSupport:
                 "unexpected '%s' opening",
             "Parser.Error.Scope.UnexpectedEndMarker":
                 "unexpected '%s' closing",
+            "Parser.Error.Scope.Unclosed":
+                "'%s' opened here is never closed",
             "Parser.Error.Scope.Outdented":
                 "outdented scope, expected indentation > %d",
             "Parser.Error.Function.UnknownFunction":
@@ -32,6 +34,8 @@ class LanguageSupport:
                 "conflicting function type",
             "Parser.Error.Function.ConflictBreak":
                 "conflicting autobreak mode",
+            "Parser.Error.Function.ConflictPure":
+                "duplicate purity flag",
             "Parser.Error.Function.ForbidChar":
                 "forbidden character in argument",
             "Parser.Error.Function.UnknownParam":
@@ -50,6 +54,16 @@ class LanguageSupport:
                 "expected line break",
             "Parser.Error.Library.FileNotFound":
                 "described library does not exist",
+            "Parser.Error.Limit.Depth":
+                "'%s' nested deeper than %d levels",
+            "Parser.Error.Limit.Expansions":
+                "'%s' called beyond the limit of %d function calls",
+            "Parser.Error.Limit.BlobScans":
+                "'%s' expanded beyond the limit of %d function outputs",
+            "Parser.Error.Limit.Time":
+                "'%s' still running after %g seconds",
+            "Parser.Error.Limit.Stack":
+                "'%s' nested too deeply for the interpreter stack",
         },
         "zh-CN": {
         },
@@ -1,11 +1,18 @@
 
+import collections
+import concurrent.futures
+import itertools
+import multiprocessing
 import os
 
+from . import cache
 from . import keywords
+from . import misc
 from . import modules
 from . import kernel
+from . import profiler
 
-from error import ParserError
+from .error import ParserError
 
 
 def make_default_functions():
@@ -30,23 +37,490 @@ def make_default_functions():
     return state.macros
 
 
-def parse_file(path, target, preload_libs=[], include_path=None):
+def preload_functions(target, preload_libs=[], include_path=None,
+                      library_cache=None):
+    """Create builtin functions along with preloaded libraries, which can be
+    shared among documents converted to the same target.
+    @param target(str) 'ctx', 'doc' or 'web'
+    @returns preloaded(DictObject) to be passed to parse_file"""
+    if include_path is None:
+        include_path = keywords.ctx_include_path
+    pobj = kernel.Parser(filepath='',
+                         filename='',
+                         document='',
+                         target=target,
+                         include_path=include_path,
+                         library_cache=cache.get_library_cache(library_cache))
+    pobj.parse(functions=make_default_functions(),
+               preload_libs=preload_libs)
+    functions = pobj.state.macros
+    return misc.DictObject(
+        target=target,
+        preload_libs=list(preload_libs),
+        functions=functions,
+        loaded_libraries=pobj.loaded_libraries,
+        dependencies=pobj.dependencies,
+        context=pobj.context,
+    )
+
+
+def open_file(path, target, preload_libs=[], include_path=None,
+              library_cache=None, preloaded=None, limits=None):
+    """Read document and prepare the parser for converting it.
+    @param limits(dict/None) limits on the cost of conversion, see
+        kernel.ParserContext.start
+    @returns pobj(kernel.Parser)
+    @returns functions(trie.Trie) initial functions
+    @returns preload_libs(list(str)) libraries yet to be loaded"""
     if target not in {'ctx', 'doc', 'web'}:
         raise ValueError(target)
     fhandle = open(path, 'r', encoding=keywords.ctx_file_encoding)
     fcontent = fhandle.read()
     fhandle.close()
+    return open_text(fcontent, path, target, preload_libs=preload_libs,
+                     include_path=include_path, library_cache=library_cache,
+                     preloaded=preloaded, limits=limits)
+
+
+def open_text(fcontent, path, target, preload_libs=[], include_path=None,
+              library_cache=None, preloaded=None, limits=None):
+    """Prepare the parser for converting a document given as text.
+    @param path(str) where the document is said to be, shown in errors
+    @returns see open_file"""
+    if target not in {'ctx', 'doc', 'web'}:
+        raise ValueError(target)
     if include_path is None:
         include_path = keywords.ctx_include_path
     pobj = kernel.Parser(filepath=os.path.dirname(path),
                          filename=os.path.basename(path),
                          document=fcontent,
                          target=target,
-                         include_path=include_path)
-    pobj.parse(functions=make_default_functions(),
-               preload_libs=preload_libs)
+                         include_path=include_path,
+                         library_cache=cache.get_library_cache(library_cache))
+    if preloaded is not None:
+        if preloaded.target != target:
+            raise ValueError(target)
+        # every document starts with fresh variables
+        pobj.context = preloaded.context.copy()
+        pobj.context.start(limits)
+        pobj.loaded_libraries = set(preloaded.loaded_libraries)
+        pobj.dependencies = dict(preloaded.dependencies)
+        return pobj, preloaded.functions, []
+    pobj.context.start(limits)
+    return pobj, make_default_functions(), preload_libs
+
+
+def load_file(path, target, preload_libs=[], include_path=None,
+              library_cache=None, preloaded=None, profile=False, limits=None):
+    """Convert document and return the parser holding the results.
+    @param profile(bool) record the cost of every function
+    @returns pobj(kernel.Parser)"""
+    pobj, functions, preload_libs = open_file(
+        path, target, preload_libs=preload_libs, include_path=include_path,
+        library_cache=library_cache, preloaded=preloaded, limits=limits)
+    if profile:
+        pobj.profiler = profiler.Profiler()
+    pobj.parse(functions=functions, preload_libs=preload_libs)
+    return pobj
+
+
+def parse_file(path, target, preload_libs=[], include_path=None,
+               library_cache=None, preloaded=None, profile=False,
+               output_cache=None, limits=None):
+    """Convert document.
+    @param output_cache(str/cache.OutputCache/None) where converted
+        documents are kept, not used when profiling
+    @returns output(dict) converted document, front matter, statistics and
+        the content hash of every library loaded by absolute path"""
+    output_cache = cache.get_output_cache(output_cache)
+    if profile:
+        output_cache = None
+    if output_cache is not None:
+        if target not in {'ctx', 'doc', 'web'}:
+            raise ValueError(target)
+        key = output_cache.make_key(
+            path, target,
+            preload_libs if preloaded is None else preloaded.preload_libs,
+            keywords.ctx_include_path if include_path is None
+            else include_path)
+        entry = output_cache.load(key)
+        if entry is not None:
+            return {
+                'document': entry['document'],
+                'headers': entry['headers'],
+                # no function was run
+                'pure_cache': {'hits': 0, 'misses': 0, 'entries': 0},
+                'dependencies': dict(entry['dependencies']),
+            }
+    pobj = load_file(path, target, preload_libs=preload_libs,
+                     include_path=include_path, library_cache=library_cache,
+                     preloaded=preloaded, profile=profile, limits=limits)
+    output = {
+        'document': pobj.document,
+        'headers': pobj.headers,
+        'pure_cache': pobj.pure_cache.get_statistics(),
+        'dependencies': dict(pobj.dependencies),
+    }
+    if profile:
+        output['profile'] = pobj.profiler.get_table()
+    if output_cache is not None:
+        output_cache.store(key, {
+            'document': pobj.document,
+            'headers': pobj.headers,
+            'dependencies': pobj.dependencies,
+        })
+    return output
+
+
+def parse_text(text, target, preload_libs=[], include_path=None,
+               library_cache=None, preloaded=None, path='', limits=None):
+    """Convert document given as text.
+    @param path(str) where the document is said to be, shown in errors
+    @returns output(dict) converted document, front matter and statistics"""
+    pobj, functions, preload_libs = open_text(
+        text, path, target, preload_libs=preload_libs,
+        include_path=include_path, library_cache=library_cache,
+        preloaded=preloaded, limits=limits)
+    pobj.parse(functions=functions, preload_libs=preload_libs)
     output = {
         'document': pobj.document,
         'headers': pobj.headers,
+        'pure_cache': pobj.pure_cache.get_statistics(),
+        'dependencies': dict(pobj.dependencies),
+    }
+    return output
+
+
+def parse_file_targets(path, targets, preload_libs=[], include_path=None,
+                       library_cache=None, executor=None):
+    """Convert document to several targets, running the first pass once for
+    all of them. Targets whose functions would change the first pass, e.g.
+    by taking other arguments, are converted on their own instead.
+    @param targets(list(str)) 'ctx', 'doc' or 'web'
+    @param executor(concurrent.futures.Executor/None) runs the second pass
+        of every target, run one after another here if None
+    @returns outputs(dict(str, dict)) output of parse_file by target"""
+    targets = list(collections.OrderedDict.fromkeys(targets))
+    if len(targets) == 0:
+        raise ValueError(targets)
+    for target in targets:
+        if target not in {'ctx', 'doc', 'web'}:
+            raise ValueError(target)
+    pobj, functions, libs = open_file(
+        path, targets[0], preload_libs=preload_libs,
+        include_path=include_path, library_cache=library_cache)
+    try:
+        passes, document = pobj.parse_shared(functions, libs, targets[1:])
+    except ParserError:
+        # every target is converted on its own, raising the error again
+        passes, document = {}, ''
+    jobs = {}
+    if executor is not None:
+        for target, (tpobj, tfunctions) in passes.items():
+            jobs[target] = executor.submit(tpobj.parse_target, tfunctions,
+                                           document)
+    outputs = collections.OrderedDict()
+    for target in targets:
+        if target not in passes:
+            outputs[target] = parse_file(
+                path, target, preload_libs=preload_libs,
+                include_path=include_path, library_cache=library_cache)
+            continue
+        tpobj, tfunctions = passes[target]
+        if target in jobs:
+            tpobj.document = jobs[target].result()
+        else:
+            tpobj.parse_target(tfunctions, document)
+        outputs[target] = {
+            'document': tpobj.document,
+            'headers': tpobj.headers,
+            'pure_cache': tpobj.pure_cache.get_statistics(),
+            'dependencies': dict(tpobj.dependencies),
+        }
+    return outputs
+
+
+def parse_file_iter(path, target, preload_libs=[], include_path=None,
+                    library_cache=None, preloaded=None):
+    """Convert document, yielding converted text paragraph by paragraph.
+    @returns generator(str)"""
+    pobj, functions, preload_libs = open_file(
+        path, target, preload_libs=preload_libs, include_path=include_path,
+        library_cache=library_cache, preloaded=preloaded)
+    return pobj.parse_iter(functions=functions, preload_libs=preload_libs)
+
+
+def parse_file_to(path, fileobj, target, preload_libs=[], include_path=None,
+                  library_cache=None, preloaded=None):
+    """Convert document, writing converted text to fileobj paragraph by
+    paragraph.
+    @param fileobj(file) text stream receiving output
+    @returns output(dict) front matter of document"""
+    pobj, functions, preload_libs = open_file(
+        path, target, preload_libs=preload_libs, include_path=include_path,
+        library_cache=library_cache, preloaded=preloaded)
+    pobj.parse_to(fileobj, functions=functions, preload_libs=preload_libs)
+    output = {
+        'headers': pobj.headers,
     }
     return output
+
+
+def format_depfile(target, dependencies):
+    """Format Makefile rule stating the files target depends on, as read by
+    make and ninja.
+    @param target(str) path to converted document
+    @param dependencies(iter(str)) paths to document and libraries
+    @returns rule(str)"""
+    def escape(path):
+        return path.replace('$', '$$').replace('#', '\\#')\
+            .replace(' ', '\\ ')
+    lines = [escape(target) + ':']
+    for path in dependencies:
+        lines.append('  ' + escape(path))
+    return ' \\\n'.join(lines) + '\n'
+
+
+def write_depfile(path, target, dependencies):
+    """Write Makefile rule stating the files target depends on.
+    @param path(str) where the rule is written to
+    @param target(str) path to converted document
+    @param dependencies(iter(str)) paths to document and libraries"""
+    fhandle = open(path, 'w', encoding=keywords.ctx_file_encoding)
+    fhandle.write(format_depfile(target, dependencies))
+    fhandle.close()
+    return
+
+
+def read_headers(path):
+    """Read the front matter of a document without converting it. The file
+    is only read as far as the front matter's end marker.
+    @returns headers(dict) contents of front matter, {} if none"""
+    def iter_lines(fhandle):
+        line = ''
+        for line in fhandle:
+            if not line.endswith('\n'):
+                break
+            yield line[:-1]
+        else:
+            line = ''
+        yield line
+        return
+
+    fhandle = open(path, 'r', encoding=keywords.ctx_file_encoding)
+    try:
+        headers, _ = kernel.Parser.read_headers(
+            iter_lines(fhandle), os.path.dirname(path),
+            os.path.basename(path))
+    finally:
+        fhandle.close()
+    return headers
+
+
+def iter_documents(folder):
+    """Find documents in directory tree, in sorted order.
+    @returns generator(str) document paths"""
+    for path, dirs, files in os.walk(folder):
+        dirs.sort()
+        for fname in sorted(files):
+            ext = os.path.splitext(fname)[1][1:]
+            if ext in keywords.ctx_document_extensions:
+                yield os.path.join(path, fname)
+    return
+
+
+def read_headers_job(paths):
+    """Read front matter of several documents in a worker.
+    @returns results(list(dict/Exception))"""
+    results = []
+    for path in paths:
+        try:
+            results.append(read_headers(path))
+        except Exception as err:
+            results.append(err)
+    return results
+
+
+def read_headers_many(paths, processes=None, chunk_size=64):
+    """Read the front matter of many documents in parallel over a process
+    pool, without converting them.
+    @param paths(iter(str)) documents, or folders searched for documents
+    @param processes(int/None) number of workers, defaults to CPU count,
+        1 reads in this process
+    @param chunk_size(int) documents handed to a worker at once
+    @returns generator((str, dict/Exception)) path and front matter (or the
+        error it raised) of each document in order"""
+    if processes is None:
+        processes = os.cpu_count() or 1
+
+    def iter_paths():
+        for path in paths:
+            if os.path.isdir(path):
+                yield from iter_documents(path)
+            else:
+                yield path
+        return
+
+    def iter_chunks():
+        chunk = []
+        for path in iter_paths():
+            chunk.append(path)
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+        if len(chunk) > 0:
+            yield chunk
+        return
+
+    if processes == 1:
+        for chunk in iter_chunks():
+            yield from zip(chunk, read_headers_job(chunk))
+        return
+    executor = concurrent.futures.ProcessPoolExecutor(max_workers=processes)
+    with executor:
+        pending = collections.deque()
+        chunks = iter_chunks()
+        exhausted = False
+        while True:
+            # keep every worker busy, and results in order
+            while not exhausted and len(pending) < processes * 2:
+                try:
+                    chunk = next(chunks)
+                except StopIteration:
+                    exhausted = True
+                    break
+                pending.append((chunk, executor.submit(read_headers_job,
+                                                       chunk)))
+            if len(pending) == 0:
+                break
+            chunk, future = pending.popleft()
+            yield from zip(chunk, future.result())
+    return
+
+
+# functions preloaded for batch conversion, inherited by forked workers
+batch_config = None
+batch_preloaded = {}  # target -> preloaded functions
+
+
+def is_preloaded_current(preloaded):
+    """Tell if none of the libraries behind preloaded functions has been
+    modified or removed since they were loaded.
+    @param preloaded(DictObject) taken from preload_functions
+    @returns bool"""
+    for path, digest in preloaded.dependencies.items():
+        try:
+            if cache.LibraryCache.read_library(path)[1] != digest:
+                return False
+        except OSError:
+            return False
+    return True
+
+
+def init_batch_worker(preload_libs, include_path, library_cache, targets,
+                      validate=False):
+    """Prepare preloaded functions for given targets, unless they had been
+    inherited from the parent process. Other targets are preloaded once
+    needed.
+    @param targets(list(str)) targets to preload now
+    @param validate(bool) drop functions whose libraries have changed"""
+    global batch_config, batch_preloaded
+    config = (list(preload_libs), include_path, library_cache)
+    if batch_config != config:
+        batch_preloaded = {}
+        batch_config = config
+    elif validate:
+        for target in list(batch_preloaded):
+            if not is_preloaded_current(batch_preloaded[target]):
+                del batch_preloaded[target]
+    for target in targets:
+        get_batch_preloaded(target)
+    return
+
+
+def get_batch_preloaded(target):
+    """Get preloaded functions of the batch for target.
+    @returns preloaded(DictObject)"""
+    if target not in batch_preloaded:
+        preload_libs, include_path, library_cache = batch_config
+        batch_preloaded[target] = preload_functions(
+            target, preload_libs=preload_libs, include_path=include_path,
+            library_cache=library_cache)
+    return batch_preloaded[target]
+
+
+def parse_batch_job(path, target, include_path, library_cache,
+                    output_cache=None, limits=None):
+    """Convert a single document in a batch worker.
+    @returns result(dict/Exception)"""
+    try:
+        return parse_file(path, target, include_path=include_path,
+                          library_cache=library_cache,
+                          preloaded=get_batch_preloaded(target),
+                          output_cache=output_cache, limits=limits)
+    except Exception as err:
+        return err
+
+
+def parse_many(jobs, preload_libs=[], include_path=None, library_cache=None,
+               processes=None, max_pending=None, output_cache=None,
+               limits=None):
+    """Convert documents in parallel over a process pool. Libraries are
+    preloaded for the target of the first document before the workers are
+    forked, so they are shared with them; workers preload them for other
+    targets once needed.
+    @param jobs(iter((str, str))) pairs of path and target
+    @param processes(int/None) number of workers, defaults to CPU count
+    @param max_pending(int/None) maximum number of documents queued or held
+        in memory at the same time, defaults to 4 per worker
+    @returns generator((str, str, dict/Exception)) path, target and output
+        (or the error it raised) of each document in order of completion"""
+    if processes is None:
+        processes = os.cpu_count() or 1
+    if max_pending is None:
+        max_pending = processes * 4
+    if isinstance(library_cache, cache.LibraryCache):
+        library_cache = library_cache.path
+    if isinstance(output_cache, cache.OutputCache):
+        output_cache = output_cache.path
+    jobs = iter(jobs)
+    first = next(jobs, None)
+    if first is None:
+        return
+    jobs = itertools.chain([first], jobs)
+    targets = [first[1]] if first[1] in {'ctx', 'doc', 'web'} else []
+    # preload in parent so that forked workers inherit the functions
+    if 'fork' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('fork')
+        init_batch_worker(preload_libs, include_path, library_cache,
+                          targets, validate=True)
+    else:
+        context = multiprocessing.get_context()
+    executor = concurrent.futures.ProcessPoolExecutor(
+        max_workers=processes, mp_context=context,
+        initializer=init_batch_worker,
+        initargs=(preload_libs, include_path, library_cache, targets))
+    with executor:
+        pending = {}
+        exhausted = False
+        while True:
+            while not exhausted and len(pending) < max_pending:
+                try:
+                    path, target = next(jobs)
+                except StopIteration:
+                    exhausted = True
+                    break
+                if target not in {'ctx', 'doc', 'web'}:
+                    raise ValueError(target)
+                future = executor.submit(parse_batch_job, path, target,
+                                         include_path, library_cache,
+                                         output_cache, limits)
+                pending[future] = (path, target)
+            if len(pending) == 0:
+                break
+            done, _ = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                path, target = pending.pop(future)
+                yield path, target, future.result()
+    return
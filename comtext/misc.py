@@ -1,4 +1,20 @@
 
+class OutputBuilder:
+    """Accumulates output chunks in linear time. Exposes write() so that it
+    may be used interchangeably with text streams."""
+
+    def __init__(self):
+        self.chunks = []
+        self.write = self.chunks.append
+        return
+
+    def getvalue(self):
+        """Get all contents written so far.
+        @returns text(str)"""
+        return ''.join(self.chunks)
+    pass
+
+
 class DictObject:
     def __init__(self, d={}, **kwargs):
         for i in d:
@@ -26,12 +42,43 @@ def split_spaces(text):
 
 def get_str_range(text, left, right):
     """Get substring text[left...right]."""
-    res = ''
-    for i in range(left, right + 1):
-        res += text[i]
+    return text[left:right + 1]
+
+
+def get_line_starts(text):
+    """Get the offsets at which each line of text begins."""
+    res = [0]
+    pos = text.find('\n')
+    while pos != -1:
+        res.append(pos + 1)
+        pos = text.find('\n', pos + 1)
     return res
 
 
+def iter_lines(text):
+    """Iterate over lines of text, splitting it only as far as consumed."""
+    begin = 0
+    pos = text.find('\n')
+    while pos != -1:
+        yield text[begin:pos]
+        begin = pos + 1
+        pos = text.find('\n', begin)
+    yield text[begin:]
+    return
+
+
+def get_line_offset(text, row):
+    """Get the offset at which line row of text begins, len(text) + 1 if
+    text has fewer lines."""
+    pos = 0
+    for _ in range(row):
+        pos = text.find('\n', pos)
+        if pos == -1:
+            return len(text) + 1
+        pos += 1
+    return pos
+
+
 def get_indent(text):
     """Get the number of leading spaces in text."""
     res = 0
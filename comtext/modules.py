@@ -1,6 +1,8 @@
 
+import copy
 import os
 
+from . import cache
 from . import jitfunction
 from . import keywords
 from . import lang
@@ -13,32 +15,53 @@ from .error import ParserError
 class ParserFunction:
     """Function executed at certain substring occurences while parsing."""
 
+    __slots__ = ()
+
     def __init__(self):
         return
 
     def parse(self, parser, state):
         return
+
+    def check(self, parser, state):
+        """Move past arguments of this function without running it, raising
+        the errors that parse would raise on misplaced scope markers.
+        @returns bool False if the rest of the document cannot be checked,
+            since it depends on the result of running this"""
+        return True
+
+    def get_signature(self):
+        """Get what the output of the first pass depends on, functions of the
+        same signature give the same output there.
+        @returns signature(tuple)"""
+        return (type(self),)
     pass
 
 
 class PfChEscape(ParserFunction):
     def parse(self, parser, state):
-        print(list(state.macros))
         err_msg = lang.text('Parser.Error.Function.UnknownFunction')
         raise ParserError({'row': state.row, 'col': state.col - 1, 'file':
                            state.filename, 'path': state.filepath,
                            'cause': err_msg})
+
+    def check(self, parser, state):
+        # may be defined by a function run before
+        return False
     pass
 
 
 class PfComment(ParserFunction):
     def parse(self, parser, state):
         kwpos = parser.match_next_keyword(state, state.pos, '\n')
-        comment = ''
-        for i in range(state.pos, kwpos):
-            comment += state.document[i]
-        state.shift_forward_mul(comment)
+        if kwpos == -1:
+            kwpos = len(state.document)
+        state.shift_forward_mul(state.document[state.pos:kwpos])
         return ''
+
+    def check(self, parser, state):
+        self.parse(parser, state)
+        return True
     pass
 
 
@@ -49,6 +72,9 @@ class PfScopeBegin(ParserFunction):
         raise ParserError({'row': state.row, 'col': state.col - 1, 'file':
                            state.filename, 'path': state.filepath,
                            'cause': err_msg})
+
+    def check(self, parser, state):
+        return self.parse(parser, state)
     pass
 
 
@@ -59,6 +85,9 @@ class PfScopeEnd(ParserFunction):
         raise ParserError({'row': state.row, 'col': state.col - 1, 'file':
                            state.filename, 'path': state.filepath,
                            'cause': err_msg})
+
+    def check(self, parser, state):
+        return self.parse(parser, state)
     pass
 
 
@@ -75,47 +104,85 @@ class PfChEscapedCharacter(ParserFunction):
 class PfLoadLibrary(ParserFunction):
     @staticmethod
     def load_library(parser_i, state, module_name):
-        fpath = os.path.dirname(module_name)
-        fname = os.path.basename(module_name)
-        found = False
-        for folder in parser_i.include_path:
-            for ext in keywords.ctx_file_extensions:
-                npath = os.path.join(folder, fpath)
-                nname = fname + '.' + ext
-                if os.path.isfile(os.path.join(npath, nname)):
-                    fpath, fname = npath, nname
-                    found = True
-                    break
-            if found:
-                break
+        found = cache.library_resolver.resolve(module_name,
+                                               parser_i.include_path)
         # no module found
-        if not found:
+        if found is None:
             err_msg = lang.text('Parser.Error.Library.FileNotFound')
             raise ParserError({'row': state.row, 'col': state.col - 1, 'file':
                                state.filename, 'path': state.filepath,
                                'cause': err_msg})
+        fpath, fname = found
         # skip if re-importing an available library
-        absp = os.path.join(fpath, fname)
+        absp = os.path.abspath(os.path.join(fpath, fname))
         if absp in parser_i.loaded_libraries:
             return ''
-        parser_i.loaded_libraries.add(absp)
+        fcontent, digest = cache.LibraryCache.read_library(absp)
+        include_path = [fpath] + parser_i.include_path
+        # load functions from compiled library if available
+        lib_cache = parser_i.library_cache
+        if lib_cache is not None:
+            key = lib_cache.make_key(absp, digest, parser_i.target,
+                                     include_path, parser_i.loaded_libraries)
+            # unless the library would redefine functions already there
+            entry = lib_cache.load(
+                key, {absp: digest}, lambda entry: not any(
+                    state.has_function(name) for name, _ in entry['macros']))
+            if entry is not None:
+                for name, func in entry['macros']:
+                    state.add_function(name, func)
+                parser_i.dependencies.update(entry['dependencies'])
+                parser_i.loaded_libraries.update(entry['dependencies'])
+                return
+            before = dict((name, state.get_function_by_name(name))
+                          for name in state.macros)
         # parse library and load functions into file
-        fhandle = open(absp, 'r', encoding=keywords.ctx_file_encoding)
-        fcontent = fhandle.read()
-        fhandle.close()
         subp = kernel.Parser(filepath=fpath,
                              filename=fname,
                              document=fcontent,
                              target=parser_i.target,
-                             include_path=[fpath] + parser_i.include_path)
-        subp.parse(functions=state.macros)
+                             include_path=include_path,
+                             library_cache=lib_cache,
+                             context=parser_i.context)
+        # libraries loaded anywhere in this document are not loaded again
+        parser_i.loaded_libraries.add(absp)
+        parser_i.dependencies[absp] = digest
+        subp.loaded_libraries = parser_i.loaded_libraries
+        # libraries define functions in bulk, checking them first would
+        # compile every definition twice
+        try:
+            subp.parse(functions=state.macros, check=False)
+        finally:
+            # libraries loaded before an error are dependencies as well
+            parser_i.dependencies.update(subp.dependencies)
         state.macros = subp.state.macros
+        # save compiled library
+        if lib_cache is not None:
+            macros = []
+            for name in state.macros:
+                func = state.get_function_by_name(name)
+                if before.get(name, None) is not func:
+                    macros.append((name, func))
+            # functions merged with the document's cannot be restored
+            if any(name in before for name, _ in macros):
+                return
+            dependencies = dict(subp.dependencies)
+            dependencies[absp] = digest
+            lib_cache.store(key, {'macros': macros,
+                                  'dependencies': dependencies})
         return
 
     def parse(self, parser_i, state):
         module_name = parser_i.match_verbatim_scope(state)
         PfLoadLibrary.load_library(parser_i, state, module_name)
+        parser_i.update_companions(
+            lambda cparser, cstate: PfLoadLibrary.load_library(
+                cparser, cstate, module_name))
         return ''
+
+    def check(self, parser_i, state):
+        # functions of the library are unknown until loaded
+        return False
     pass
 
 
@@ -211,6 +278,18 @@ class PfDefFunction(ParserFunction):
             return True
         return False
 
+    @staticmethod
+    def pfd_pure(parser, state, param, out):
+        if param == keywords.func_opt_pure:
+            if out['pure']:
+                err_msg = lang.text('Parser.Error.Function.ConflictPure')
+                raise ParserError({'row': state.row, 'col': state.col - 1,
+                                   'file': state.filename, 'path': state.
+                                   filepath, 'cause': err_msg})
+            out['pure'] = True
+            return True
+        return False
+
     @staticmethod
     def parse_function_def(parser, state, text):
         # get function name
@@ -237,6 +316,7 @@ class PfDefFunction(ParserFunction):
             'args': [],  # {'name': '...', 'verbatim': True}
             'mode': '',
             'autobreak': '',
+            'pure': False,  # results may be reused for same arguments
         }
         for param in params:
             if PfDefFunction.pfd_lang_args(parser, state, param, out):
@@ -245,6 +325,8 @@ class PfDefFunction(ParserFunction):
                 continue
             if PfDefFunction.pfd_auto_break(parser, state, param, out):
                 continue
+            if PfDefFunction.pfd_pure(parser, state, param, out):
+                continue
             # unknown parameter
             err_msg = lang.text('Parser.Error.Function.UnknownParam')
             raise ParserError({'row': state.row, 'col': state.col - 1,
@@ -300,16 +382,19 @@ class PfDefFunction(ParserFunction):
                   }.get(parser.target, '')}
         return modes
 
-    def parse(self, parser, state):
-        params, code = PfDefFunction.parse_function(parser, state)
+    @staticmethod
+    def define(parser, state, fname, func_type, params, code):
+        """Define or update function fname, unless it is for another target.
+        @param func_type(type) PfDynamicFunction or PfDynamicEnvironment"""
+        # definitions for other targets are dropped
+        if params['mode'] not in PfDefFunction.available_modes(parser):
+            return
         # retrieve dynamic function
-        fname = keywords.kw_dyn_function % params['name']
         if state.has_function(fname):
-            is_new = False
-            func = state.get_function_by_name(fname)
+            # functions may be shared with other documents, update a copy
+            func = copy.copy(state.get_function_by_name(fname))
         else:
-            is_new = True
-            func = PfDynamicFunction()
+            func = func_type()
         # update parameters and code
         if not func.update_config(params):
             err_msg = lang.text('Parser.Error.Function.ParamMismatch')
@@ -317,23 +402,53 @@ class PfDefFunction(ParserFunction):
                                state.filename, 'path': state.filepath,
                                'cause': err_msg})
         func.update_function(parser, state, params, code)
-        if is_new and params['mode'] in PfDefFunction.available_modes(parser):
-            state.add_function(fname, func)
+        func.source = os.path.join(state.filepath, state.filename)
+        state.add_function(fname, func)
+        return
+
+    @staticmethod
+    def declare(parser, state, fname, func_type, params):
+        """Make function fname known to check_block by its arguments, without
+        compiling its code, which is then assumed to alter the functions.
+        @param func_type(type) PfDynamicFunction or PfDynamicEnvironment"""
+        if params['mode'] not in PfDefFunction.available_modes(parser):
+            return
+        if state.has_function(fname):
+            func = copy.copy(state.get_function_by_name(fname))
+        else:
+            func = func_type()
+        if not func.update_config(params):
+            err_msg = lang.text('Parser.Error.Function.ParamMismatch')
+            raise ParserError({'row': state.row, 'col': state.col - 1, 'file':
+                               state.filename, 'path': state.filepath,
+                               'cause': err_msg})
+        func.raw_func = None
+        func.py_func = PfDynamicFunction.unknown_code
+        state.add_function(fname, func)
+        return
+
+    def parse(self, parser, state):
+        params, code = PfDefFunction.parse_function(parser, state)
+        fname = keywords.kw_dyn_function % params['name']
+        PfDefFunction.define(parser, state, fname, PfDynamicFunction, params,
+                             code)
+        parser.update_companions(
+            lambda cparser, cstate: PfDefFunction.define(
+                cparser, cstate, fname, PfDynamicFunction, params, code))
         return ''
+
+    def check(self, parser, state):
+        params, _ = PfDefFunction.parse_function(parser, state)
+        PfDefFunction.declare(parser, state, keywords.kw_dyn_function %
+                              params['name'], PfDynamicFunction, params)
+        return True
     pass
 
 
 class PfDefEnvironment(ParserFunction):
-    def parse(self, parser, state):
+    @staticmethod
+    def parse_environment(parser, state):
         params, code = PfDefFunction.parse_function(parser, state)
-        # retrieve dynamic function
-        fname = keywords.kw_dyn_environment_begin % params['name']
-        if state.has_function(fname):
-            is_new = False
-            func = state.get_function_by_name(fname)
-        else:
-            is_new = True
-            func = PfDynamicEnvironment()
         # addition limits
         if len(params['args']) == 0:
             err_msg = lang.text('Parser.Error.Environment.TooFewArgs')
@@ -345,16 +460,23 @@ class PfDefEnvironment(ParserFunction):
             raise ParserError({'row': state.row, 'col': state.col - 1, 'file':
                                state.filename, 'path': state.filepath,
                                'cause': err_msg})
-        # update parameters and code
-        if not func.update_config(params):
-            err_msg = lang.text('Parser.Error.Function.ParamMismatch')
-            raise ParserError({'row': state.row, 'col': state.col - 1, 'file':
-                               state.filename, 'path': state.filepath,
-                               'cause': err_msg})
-        func.update_function(parser, state, params, code)
-        if is_new and params['mode'] in PfDefFunction.available_modes(parser):
-            state.add_function(fname, func)
+        return params, code
+
+    def parse(self, parser, state):
+        params, code = PfDefEnvironment.parse_environment(parser, state)
+        fname = keywords.kw_dyn_environment_begin % params['name']
+        PfDefFunction.define(parser, state, fname, PfDynamicEnvironment,
+                             params, code)
+        parser.update_companions(
+            lambda cparser, cstate: PfDefFunction.define(
+                cparser, cstate, fname, PfDynamicEnvironment, params, code))
         return ''
+
+    def check(self, parser, state):
+        params, _ = PfDefEnvironment.parse_environment(parser, state)
+        PfDefFunction.declare(parser, state, keywords.kw_dyn_environment_begin
+                              % params['name'], PfDynamicEnvironment, params)
+        return True
     pass
 
 
@@ -364,6 +486,10 @@ class PfEnvironmentBegin(ParserFunction):
         raise ParserError({'row': state.row, 'col': state.col, 'file':
                            state.filename, 'path': state.filepath,
                            'cause': err_msg})
+
+    def check(self, parser, state):
+        # may be defined by a function run before
+        return False
     pass
 
 
@@ -374,10 +500,20 @@ class PfEnvironmentEnd(ParserFunction):
         raise ParserError({'row': state.row, 'col': state.col - 1, 'file':
                            state.filename, 'path': state.filepath,
                            'cause': err_msg})
+
+    def check(self, parser, state):
+        return False
     pass
 
 
 class PfDynamicFunction(ParserFunction):
+    # one per defined function, slots keep large libraries small
+    __slots__ = ('function_name', 'args_vb', 'mode', 'py_func', 'raw_func',
+                 'autobreak', 'pure', 'source')
+
+    # code of functions declared by check_block, never run
+    unknown_code = object()
+
     def __init__(self):
         self.function_name = None
         self.args_vb = None  # verbatim parse or not
@@ -385,6 +521,8 @@ class PfDynamicFunction(ParserFunction):
         self.py_func = None
         self.raw_func = None
         self.autobreak = None
+        self.pure = False
+        self.source = None  # file of latest definition
         return
 
     def update_config(self, params):
@@ -398,17 +536,20 @@ class PfDynamicFunction(ParserFunction):
             if len(self.args_vb) != len(params['args']):
                 return False
             for i in range(0, len(self.args_vb)):
-                if self.args_vb[i] != params['args']['verbatim']:
+                if self.args_vb[i] != params['args'][i]['verbatim']:
                     return False
             if self.mode != params['mode']:
                 return False
             if self.autobreak != params['autobreak']:
                 return False
+            if self.pure != params['pure']:
+                return False
             return True
         self.function_name = params['name']
-        self.args_vb = list(i['verbatim'] for i in params['args'])
+        self.args_vb = tuple(i['verbatim'] for i in params['args'])
         self.mode = params['mode']
         self.autobreak = params['autobreak']
+        self.pure = params['pure']
         return True
 
     def update_function(self, parser, state, params, code):
@@ -430,6 +571,18 @@ class PfDynamicFunction(ParserFunction):
             self.raw_func = jitfunction.JitFunctionRaw(fname, args, code)
         return
 
+    def get_signature(self):
+        executed = self.mode == keywords.func_proc_src_after
+        res = (type(self), self.args_vb, self.autobreak, executed)
+        # run by the first pass, which then depends on the code as well
+        if executed:
+            res += (getattr(self.raw_func, 'binary', None),
+                    getattr(self.py_func, 'code', None), self.pure)
+        return res
+
+    def get_name(self):
+        return keywords.kw_dyn_function % self.function_name
+
     def check_do_exec(self, state):
         return (state.target, self.mode) in {
                 ('ctx', keywords.func_proc_src_after),
@@ -446,15 +599,97 @@ class PfDynamicFunction(ParserFunction):
                 res += parser.close_auto_break(state)
         return res
 
+    def check_code(self, parser, state, visited):
+        """Tell if running this function keeps the functions unchanged, the
+        ones defined while running are unknown to check_block.
+        @param visited(set) functions being checked, to stop recursion
+        @returns bool True if it does not define or load functions"""
+        if not PfDynamicFunction.check_do_exec(self, state):
+            return True
+        if self.py_func is not None:
+            return False
+        if self.raw_func is None:
+            return True
+        visited.add(self)
+        binary = self.raw_func.binary
+        for i in range(0, len(binary)):
+            code = binary[i]
+            if code.__class__ is not str:
+                continue
+            for kw in keywords.kw_macro_defs:
+                if kw in code:
+                    return False
+            # expansion is parsed again, along with functions called by it
+            pos = code.find(keywords.ch_escape)
+            while pos != -1:
+                func_name = state.macros.match(code, pos)
+                end = pos + len(func_name)
+                func = state.macros.find(func_name)
+                # names may go on with the argument that follows
+                if end == len(code) and i + 1 < len(binary):
+                    return False
+                if isinstance(func, (PfDynamicFunction,
+                                     PfDynamicEnvironment)):
+                    if func not in visited and not PfDynamicFunction.\
+                            check_code(func, parser, state, visited):
+                        return False
+                elif func is None or isinstance(func, PfChEscape):
+                    return False
+                pos = code.find(keywords.ch_escape, max(end, pos + 1))
+        return True
+
+    def check_expansion(self, parser, state, source):
+        """Tell if running this function, called as source, keeps the
+        functions unchanged.
+        @param source(str) function call in document
+        @returns bool"""
+        if not PfDynamicFunction.check_do_exec(self, state):
+            return True
+        # verbatim arguments are expanded as they are
+        for kw in keywords.kw_macro_defs:
+            if kw in source:
+                return False
+        key = (self, state.macros.snapshot())
+        res = parser.checked_expansions.get(key, None)
+        if res is None:
+            res = PfDynamicFunction.check_code(self, parser, state, set())
+            parser.checked_expansions[key] = res
+        return res
+
+    def check(self, parser, state):
+        begin = state.pos
+        for verbatim in self.args_vb:
+            if verbatim:
+                parser.match_verbatim_scope(state)
+            elif not parser.check_parsable_scope(state):
+                return False
+        source = state.document[begin:state.pos]
+        return self.check_expansion(parser, state, source)
+
     def call_function(self, parser, state, do_exec, args, res):
         tmp = ''
         if do_exec:
+            # expansions of pure functions only depend on the arguments and
+            # the macros they are expanded with
+            if self.pure:
+                key = (self, state.target, tuple(args),
+                       state.macros.snapshot())
+                entry = parser.pure_cache.get(key)
+                if entry is not None:
+                    state.exec_count += entry[1]
+                    return res + entry[0]
+                exec_count = state.exec_count
             if self.raw_func is not None:
                 tmp = str(self.raw_func.eval(*args))
             elif self.py_func is not None:
-                tmp = str(self.py_func.eval(*args))
+                parser.py_exec_count += 1
+                tmp = str(self.py_func.eval(parser.context, *args))
             if state.target == 'ctx':
-                tmp = parser.parse_blob(state, tmp)
+                tmp = parser.parse_blob(state, tmp, self.get_name())
+            # unless the expansion defined functions itself
+            if self.pure and state.macros.data is key[3]:
+                parser.pure_cache.put(key, (tmp, state.exec_count -
+                                            exec_count))
             res += tmp
         return res
 
@@ -484,14 +719,22 @@ class PfDynamicFunction(ParserFunction):
 
 
 class PfDynamicEnvironment(ParserFunction):
+    __slots__ = PfDynamicFunction.__slots__
+
     def __init__(self):
         self.function_name = None
-        self.args_vb = []  # verbatim parse or not
+        self.args_vb = ()  # verbatim parse or not
         self.mode = None
         self.py_func = None
         self.raw_func = None
+        self.autobreak = None
+        self.pure = False
+        self.source = None  # file of latest definition
         return
 
+    def get_name(self):
+        return keywords.kw_dyn_environment_begin % self.function_name
+
     def update_config(self, params):
         return PfDynamicFunction.update_config(self, params)
 
@@ -536,6 +779,26 @@ class PfDynamicEnvironment(ParserFunction):
             res += '\n' + args[-1] + '\n' + fn_end
             state.exec_count -= 1
         return res
+
+    def check(self, parser, state):
+        begin = state.pos
+        indent = parser.get_current_indent(state)
+        for verbatim in self.args_vb[:-1]:
+            if verbatim:
+                parser.match_verbatim_scope(state)
+            elif not parser.check_parsable_scope(state):
+                return False
+        if not state.document.startswith('\n', state.pos):
+            err_msg = lang.text('Parser.Error.Environment.ExpectedLineBreak')
+            raise ParserError({'row': state.row, 'col': state.col - 1,
+                               'file': state.filename, 'path': state.
+                               filepath, 'cause': err_msg})
+        state.shift_forward('\n')
+        fn_end = keywords.kw_dyn_environment_end % self.function_name
+        parser.match_to_next_occurence(state, '\n' + ' ' * indent + fn_end,
+                                       sub_display_error=fn_end)
+        source = state.document[begin:state.pos]
+        return PfDynamicFunction.check_expansion(self, parser, state, source)
     pass
 
 
@@ -545,22 +808,24 @@ class PfParagraph(ParserFunction):
         prev_abs = state.autobreak.enabled
         state.autobreak.enabled = False
         tmp = parser.match_parsable_scope(state)
-        state.autobreak.mode = prev_abs
+        state.autobreak.enabled = prev_abs
         output += tmp + parser.close_auto_break(state)
         return output
+
+    def check(self, parser, state):
+        return parser.check_parsable_scope(state)
     pass
 
 
 class PfMathMode(ParserFunction):
-    def parse(self, parser, state):
-        # process auto break
-        res = parser.flush_auto_break(state)
-        if state.autobreak.enabled:
-            res += parser.open_auto_break(state)
-        # retrieve contents
+    @staticmethod
+    def match_math(parser, state):
+        """Match contents until the closing mark of math mode.
+        @returns output(str) contents"""
         escaped = False
         found = False
-        output = ''
+        begin = state.pos
+        end = begin
         mark = keywords.ch_esc_chars['dollar']['default']
         while state.pos < len(state.document):
             ch = state.document[state.pos]
@@ -568,12 +833,12 @@ class PfMathMode(ParserFunction):
                 escaped = not escaped
             elif ch == mark:
                 if not escaped:
+                    end = state.pos
                     state.shift_forward(ch)
                     found = True
                     break
             else:
                 escaped = False
-            output += ch
             state.shift_forward(ch)
         # no end marker
         if not found:
@@ -581,6 +846,15 @@ class PfMathMode(ParserFunction):
             raise ParserError({'row': state.row, 'col': state.col - 1,
                                'file': state.filename, 'path': state.
                                filepath, 'cause': err_msg})
+        return state.document[begin:end]
+
+    def parse(self, parser, state):
+        # process auto break
+        res = parser.flush_auto_break(state)
+        if state.autobreak.enabled:
+            res += parser.open_auto_break(state)
+        # retrieve contents
+        output = PfMathMode.match_math(parser, state)
         # process
         if state.target == 'doc':
             res += keywords.math_mode_doc % output
@@ -590,4 +864,8 @@ class PfMathMode(ParserFunction):
         else:
             res += keywords.math_mode_ctx % output
         return res
+
+    def check(self, parser, state):
+        PfMathMode.match_math(parser, state)
+        return True
     pass
@@ -0,0 +1,89 @@
+import time
+
+from . import misc
+
+
+class Profiler:
+    """Records the cost of every function called while parsing, per pass
+    and function name. Time spent in nested functions counts towards the
+    inclusive time of the caller but not its exclusive time."""
+
+    def __init__(self):
+        self.entries = {}  # (target, function name) -> statistics
+        self.stack = []  # [key, time spent in callees] of running functions
+        self.active = {}  # key -> number of running calls, for recursion
+        return
+
+    def get_entry(self, key, func):
+        entry = self.entries.get(key, None)
+        if entry is None:
+            entry = misc.DictObject(
+                calls=0,
+                inclusive=0.0,
+                exclusive=0.0,
+                blob_scans=0,  # parse_blob runs over output of this
+                blob_chars=0,
+                output_chars=0,
+                # builtin functions are not defined in any file
+                source=getattr(func, 'source', None),
+            )
+            self.entries[key] = entry
+        return entry
+
+    def call(self, name, func, parser, state):
+        """Run func.parse and record its cost.
+        @param name(str) function name matched in document
+        @returns output(str) converted text"""
+        key = (state.target, name)
+        entry = self.get_entry(key, func)
+        frame = [key, 0.0]
+        self.stack.append(frame)
+        self.active[key] = self.active.get(key, 0) + 1
+        begin = time.perf_counter()
+        res = ''
+        try:
+            res = func.parse(parser, state)
+        finally:
+            # counted even if the function raised, keeping callers' times
+            elapsed = time.perf_counter() - begin
+            self.stack.pop()
+            self.active[key] -= 1
+            # recursive calls are already included in the outermost one
+            if self.active[key] == 0:
+                entry.inclusive += elapsed
+            entry.exclusive += elapsed - frame[1]
+            if len(self.stack) > 0:
+                self.stack[-1][1] += elapsed
+            entry.calls += 1
+            entry.output_chars += len(res)
+        return res
+
+    def add_blob(self, blob):
+        """Record a parse_blob run for the running function.
+        @param blob(str) output being expanded"""
+        if len(self.stack) == 0:
+            return
+        entry = self.entries[self.stack[-1][0]]
+        entry.blob_scans += 1
+        entry.blob_chars += len(blob)
+        return
+
+    def get_table(self):
+        """Get statistics of every function, most expensive first.
+        @returns table(list(dict))"""
+        table = []
+        for (target, name), entry in self.entries.items():
+            table.append({
+                'name': name,
+                'pass': target,
+                'calls': entry.calls,
+                'inclusive': entry.inclusive,
+                'exclusive': entry.exclusive,
+                'blob_scans': entry.blob_scans,
+                'blob_chars': entry.blob_chars,
+                'output_chars': entry.output_chars,
+                'source': entry.source,
+            })
+        table.sort(key=lambda i: i['exclusive'], reverse=True)
+        return table
+    pass
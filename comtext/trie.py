@@ -1,21 +1,45 @@
+import re
+
 
 class Trie:
-    """Traversable dictionary tree."""
+    """Dictionary of functions by name, supporting longest match against a
+    document. Names made of the escape character and an identifier, which
+    are the vast majority, are resolved with a single dictionary lookup;
+    other names (symbols) are kept in a trie stored as flat tables. Copies
+    share their contents with the original, which are only duplicated once
+    either side modifies them (copy-on-write)."""
+
+    ident_pattern = re.compile(r'\\[^\W_]+')
+
+    __slots__ = ('data', 'shared')
+
+    class TrieData:
+        """Contents of a dictionary, read-only once shared."""
 
-    class TrieNode:
-        """Node for a dictionary tree."""
+        __slots__ = ('names', 'edges', 'flags', 'leading')
 
-        def __init__(self, val, flag):
-            self.key = val
-            self.parent = None
-            self.children = {}
-            self.flag = flag
+        def __init__(self):
+            self.names = {}  # name -> flag, of all names
+            # symbol trie, node 0 is the root
+            self.edges = {}  # (node, character) -> child node
+            self.flags = [None]  # node -> flag
+            self.leading = None  # sorted leading characters, built on demand
             return
+
+        def copy(self):
+            res = Trie.TrieData()
+            res.names = dict(self.names)
+            res.edges = dict(self.edges)
+            res.flags = list(self.flags)
+            res.leading = self.leading
+            return res
         pass
 
     class TrieIterator:
         """Iterator object."""
 
+        __slots__ = ('trie', 'gen')
+
         def __init__(self, trie):
             self.trie = trie
             self.gen = self.trie.traverse_tree()
@@ -26,64 +50,106 @@ class Trie:
         pass
 
     def __init__(self):
-        self.root = self.TrieNode('', None)
+        self.data = self.TrieData()
+        self.shared = False  # if data may be read by other tries
         return
 
+    def copy(self):
+        """Create a copy of the dictionary in O(1), contents are shared until
+        modified.
+        @returns trie(Trie)"""
+        res = Trie()
+        res.data = self.data
+        res.shared = True
+        self.shared = True
+        return res
+
+    def snapshot(self):
+        """Get contents as they are now, which are left unchanged from here
+        on, so that changes can be told by identity.
+        @returns data(TrieData)"""
+        self.shared = True
+        return self.data
+
+    def own_data(self):
+        """Get contents that may be modified by this trie."""
+        if self.shared:
+            self.data = self.data.copy()
+            self.shared = False
+        return self.data
+
     def insert(self, string, flag):
         """Insert string into the dictionary.
         @param string(str) the string to insert
         @param flag(...) the object to mark upon discovery of the string"""
-        p = self.root
-        for i in range(0, len(string)):
-            ch = string[i]
-            if ch not in p.children:
-                q = self.TrieNode(string[i], None)
-                q.parent = p
-                p.children[ch] = q
-                p = q
-            else:
-                p = p.children[ch]
-        p.flag = flag
+        data = self.own_data()
+        data.names[string] = flag
+        if data.leading is not None and string[:1] not in data.leading:
+            data.leading = ''.join(sorted(data.leading + string[:1]))
+        match = Trie.ident_pattern.match(string)
+        if match is not None and match.end() == len(string):
+            return
+        p = 0
+        for ch in string:
+            q = data.edges.get((p, ch), None)
+            if q is None:
+                q = len(data.flags)
+                data.flags.append(None)
+                data.edges[(p, ch)] = q
+            p = q
+        data.flags[p] = flag
         return
 
     def find(self, string):
         """Find if string exists in dictionary and return its flag.
         @param string(str) the string to search for
         @returns ... the flag of the string"""
-        p = self.root
-        for i in range(0, len(string)):
-            ch = string[i]
-            if ch not in p.children:
-                return None
-            p = p.children[ch]
-        return p.flag
+        return self.data.names.get(string, None)
+
+    def match(self, text, begin):
+        """Find the longest name that text continues with at begin.
+        @param text(str) document
+        @param begin(int) position of match begin
+        @returns name(str) '' if none matches"""
+        data = self.data
+        res = ''
+        # identifiers, shortened until known if no name matches in full
+        match = Trie.ident_pattern.match(text, begin)
+        if match is not None:
+            name = match.group()
+            while len(name) > 1:
+                if name in data.names:
+                    res = name
+                    break
+                name = name[:-1]
+        # symbols, which may be longer, e.g. environments
+        edges = data.edges
+        flags = data.flags
+        p = 0
+        end = begin
+        for i in range(begin, len(text)):
+            p = edges.get((p, text[i]), None)
+            if p is None:
+                break
+            if flags[p] is not None:
+                end = i + 1
+        if end - begin > len(res):
+            res = text[begin:end]
+        return res
+
+    def get_leading_chars(self):
+        """Get characters that names may begin with.
+        @returns chars(str) sorted characters"""
+        data = self.data
+        if data.leading is None:
+            data.leading = ''.join(sorted(set(i[:1] for i in data.names)))
+        return data.leading
 
     def traverse_tree(self):
-        """Creates a generator used to traverse all nodes."""
-        # set default pointer
-        p = self.root
-        stack = [iter(p.children)]
-        text = ''
-        # traverse as stack
-        while len(stack) > 0:
-            i = stack[len(stack) - 1]
-            # recurse if no children
-            try:
-                ch = next(i)
-                p = p.children[ch]
-                text += ch
-                i = iter(p.children)
-                stack.append(i)
-            except StopIteration:
-                if p.flag is not None:
-                    yield text
-                p = p.parent
-                text = text[:-1]
-                stack.pop()
-                continue
-            pass
-        # nothing else to traverse
-        raise StopIteration
+        """Creates a generator used to traverse all names."""
+        for name in list(self.data.names):
+            yield name
+        return
 
     def __iter__(self):
         """Implement iter(self)."""